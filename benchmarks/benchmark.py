@@ -0,0 +1,540 @@
+#! /usr/bin/python
+
+# Copyright 2016 Antonio Arriaga Diaz <antonio.arriaga.diaz@gmail.com >
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks of the cisco modules against simulated routers (iossim.py).
+#
+# The modules are loaded from the roles and their sessions are replaced by
+# simulated ones, so the dependencies of the modules (ansible, netlib,
+# netaddr, pyserial) must be installed. For every case the wall time of
+# every phase, the round trips, the bytes on the wire, the parsing time and
+# the peak memory are reported. Phases run by several workers at once add
+# up the time of every worker. Every case runs in a process of its own, and
+# the exit status is 1 when a case fails or reports errors.
+#
+#   python benchmarks/benchmark.py --devices 10 --interfaces 100,1000 --latency 0.05
+#   python benchmarks/benchmark.py --suite facts --json results.json
+#   python benchmarks/benchmark.py --suite exec --line-cost 0.002 --vty-buffer 20 --window 100
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import traceback
+import multiprocessing
+
+try:
+  from queue import Empty
+except ImportError:
+  from Queue import Empty
+
+import iossim
+
+try:
+  from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+  import imp
+  spec_from_file_location = None
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = {
+  'facts': os.path.join(ROOT, 'roles', 'cisco', 'library', 'cisco_gather_facts.py'),
+  'exec': os.path.join(ROOT, 'roles', 'cisco', 'library', 'cisco_exec_commands.py'),
+  'serial': os.path.join(ROOT, 'roles', 'serialConnectedCisco', 'library', 'cisco-serial.py'),
+}
+
+
+def loadModule(name):
+  # A fresh copy every time, the benchmarks patch module globals
+  moduleName = 'bench_' + name.replace('-', '_')
+  if spec_from_file_location is None:
+    return imp.load_source(moduleName, MODULES[name])
+  spec = spec_from_file_location(moduleName, MODULES[name])
+  module = module_from_spec(spec)
+  # Process pools pickle the module functions by name
+  sys.modules[moduleName] = module
+  spec.loader.exec_module(module)
+  return module
+
+
+class memoryPeak(object):
+  # Peak of the traced allocations, or of the process when tracemalloc is
+  # missing: ru_maxrss never goes down, only a process per case makes it
+  # the peak of that case
+  def __enter__(self):
+    self.peak = 0
+    if tracemalloc is not None:
+      tracemalloc.start()
+    return self
+
+  def __exit__(self, *exc):
+    if tracemalloc is not None:
+      self.peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+    elif resource is not None:
+      # Kilobytes on Linux
+      self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return False
+
+
+class phaseTimer(object):
+  """Wall time spent in the wrapped methods, by phase name"""
+  def __init__(self):
+    self.times = {}
+    self.lock = threading.Lock()
+
+  def wrap(self, owner, method, phase):
+    original = getattr(owner, method)
+    timer = self
+
+    def timed(*args, **kwargs):
+      start = time.time()
+      try:
+        result = original(*args, **kwargs)
+        if hasattr(result, 'next') or hasattr(result, '__next__'):
+          # Generators are timed while consumed
+          return timer.timedIterator(result, phase)
+        return result
+      finally:
+        timer.add(phase, time.time() - start)
+    setattr(owner, method, timed)
+
+  def timedIterator(self, iterator, phase):
+    while True:
+      start = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        self.add(phase, time.time() - start)
+        return
+      self.add(phase, time.time() - start)
+      yield item
+
+  def add(self, phase, seconds):
+    with self.lock:
+      self.times[phase] = self.times.get(phase, 0) + seconds
+
+  def report(self):
+    return dict((phase, round(seconds, 4)) for phase, seconds in self.times.items())
+
+
+class simFactory(object):
+  """openSession replacement, keeps every simulated session for the counters"""
+  def __init__(self, scale, latency, bandwidth, delay, connectTime, lineCost=0.0, buffer=0):
+    self.scale = scale
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.delay = delay
+    self.connectTime = connectTime
+    self.lineCost = lineCost
+    self.buffer = buffer
+    self.sessions = []
+    self.lock = threading.Lock()
+
+  def __call__(self, hostname, username, password, enable, broker=None, timings=None):
+    device = iossim.iosDevice(hostname=hostname.replace('.', '-'), **self.scale)
+    ssh = iossim.simSSH(device, self.latency, self.bandwidth, self.delay, self.connectTime,
+                        self.lineCost, self.buffer)
+    start = time.time()
+    ssh.connect()
+    connected = time.time()
+    ssh.set_enable(enable)
+    if timings is not None:
+      timings.phase('connect', connected - start)
+      timings.phase('enable', time.time() - connected)
+    with self.lock:
+      self.sessions.append(ssh)
+    return ssh
+
+  def counters(self):
+    return dict(
+      sessions=len(self.sessions),
+      commands=sum(ssh.commands for ssh in self.sessions),
+      roundTrips=sum(ssh.client_conn.sends for ssh in self.sessions),
+      bytesSent=sum(ssh.client_conn.bytesSent for ssh in self.sessions),
+      bytesReceived=sum(ssh.client_conn.bytesReceived for ssh in self.sessions))
+
+
+def benchFacts(args, scale, variant):
+  module = loadModule('facts')
+  factory = simFactory(scale, args.latency, args.bandwidth, args.delay, args.connect)
+  module.openSession = factory
+  timer = phaseTimer()
+  for method in ('gather', 'interfacesLinesManipulate', 'briefReportManipulate',
+                 'bgpReportManipulate', 'vrfReportManipulate', 'versionReportManipulate'):
+    phase = 'gather' if method == 'gather' else 'parse'
+    timer.wrap(module.ciscoRouter, method, phase)
+  timer.wrap(module, 'openSession', 'connect')
+
+  parsePool = None
+  if variant == 'pool':
+    # Parsed in other processes, parse only counts what is left in the threads
+    parsePool = multiprocessing.Pool(args.parse_workers)
+
+  devices = [module.ciscoRouter(hostname='10.0.%d.%d' % (number // 250, number % 250 + 1),
+                                username='admin', password='admin', enable='admin',
+                                burst=variant == 'burst',
+                                interfacesMode='brief' if variant == 'brief' else 'full',
+                                parsePool=parsePool)
+             for number in range(args.devices)]
+
+  try:
+    with memoryPeak() as memory:
+      start = time.time()
+      facts, deltas, errors, timings = module.gatherFacts(devices, args.workers, index=False)
+      elapsed = time.time() - start
+  finally:
+    if parsePool is not None:
+      parsePool.close()
+
+  result = dict(suite='facts', variant=variant, devices=args.devices, errors=len(errors),
+                wall=round(elapsed, 4), phases=timer.report(), peakMemory=memory.peak)
+  if errors:
+    result['error'] = sorted(errors.items())[0]
+  result.update(scale)
+  result.update(factory.counters())
+  return result
+
+
+def writeCaptures(module, directory, scale, devices):
+  # Saved show outputs of every router, one file per command
+  hostnames = []
+  for number in range(devices):
+    device = iossim.iosDevice(hostname='R%d' % number, **scale)
+    os.makedirs(os.path.join(directory, device.hostname))
+    for key, command in module.SHOW_COMMANDS:
+      with open(os.path.join(directory, device.hostname, module.captureName(command)), 'w') as f:
+        f.write(device.execute(command))
+    hostnames.append(device.hostname)
+  return hostnames
+
+
+def benchOffline(args, scale, variant):
+  module = loadModule('facts')
+  directory = tempfile.mkdtemp()
+  try:
+    hostnames = writeCaptures(module, directory, scale, args.devices)
+    devices = [module.ciscoRouter(hostname=hostname, capture=directory, timings=True)
+               for hostname in hostnames]
+    with memoryPeak() as memory:
+      start = time.time()
+      facts, deltas, errors, timings = module.gatherFacts(devices, args.workers, index=False,
+                                                          processes=variant == 'processes')
+      elapsed = time.time() - start
+  finally:
+    shutil.rmtree(directory)
+
+  # The timings of the module, the parsers may run in other processes
+  phases = dict(
+    read=sum(sum(entry['seconds'] for entry in hostTimings['commands'].values())
+             for hostTimings in timings.values()),
+    parse=sum(sum(hostTimings['parsers'].values()) for hostTimings in timings.values()))
+  result = dict(suite='offline', variant=variant, devices=args.devices, errors=len(errors),
+                wall=round(elapsed, 4), phases=phases, peakMemory=memory.peak)
+  if errors:
+    result['error'] = sorted(errors.items())[0]
+  result.update(scale)
+  return result
+
+
+def benchParsers(args, scale, repeat=5):
+  # Lines per second of every parser of every engine on the same outputs
+  module = loadModule('facts')
+  device = iossim.iosDevice(**scale)
+  echo = lambda command, output: "%s#%s\r\n%s%s#" % (device.hostname, command, output, device.hostname)
+  reports = dict((key, echo(command, device.execute(command))) for key, command in module.SHOW_COMMANDS)
+  cases = [
+    ('interfaces', 'interfacesReportManipulate', (reports['interfaces'],)),
+    ('vrf', 'vrfReportManipulate', (reports['vrf'],)),
+    ('bgp', 'bgpReportManipulate', (reports['bgp'], reports['rd'])),
+    ('version', 'versionReportManipulate', (reports['version'],)),
+    ('hostname', 'hostnameReportManipulate', (reports['hostname'],)),
+  ]
+
+  results = []
+  for name, method, args_ in cases:
+    lines = sum(report.count('\n') + 1 for report in args_)
+    outputs = {}
+    for parser, router in sorted(module.PARSERS.items()):
+      function = getattr(router(), method)
+      start = time.time()
+      for count in range(repeat):
+        outputs[parser] = function(*args_)
+      elapsed = (time.time() - start) / repeat
+      results.append(dict(suite='parsers', variant=parser, parser=name, lines=lines,
+                          wall=round(elapsed, 6), phases={},
+                          linesPerSecond=int(lines / elapsed) if elapsed else 0))
+    # Every engine must build the same facts as the first one
+    same = all(output == outputs['legacy'] for output in outputs.values())
+    for result in results[-len(outputs):]:
+      result['same'] = same
+  return results
+
+
+def configurationFile(lines):
+  handle, path = tempfile.mkstemp(suffix='.cfg')
+  with os.fdopen(handle, 'w') as f:
+    f.write("configure terminal\n")
+    for number in range(lines):
+      f.write("interface Loopback%d\n" % (1000 + number))
+      f.write(" ip address 10.%d.%d.1 255.255.255.255\n" % (number // 250, number % 250))
+      f.write("exit\n")
+    f.write("end\n")
+  return path
+
+
+def benchExec(args, lines, variant):
+  module = loadModule('exec')
+  factory = simFactory(dict(interfaces=0), args.latency, args.bandwidth, args.delay, args.connect,
+                       args.line_cost, args.vty_buffer)
+  timer = phaseTimer()
+  timer.wrap(module, 'executeCommandList', 'execute')
+  path = configurationFile(lines)
+  try:
+    with memoryPeak() as memory:
+      start = time.time()
+      ssh = factory('10.0.0.1', 'admin', 'admin', 'admin')
+      if variant == 'transaction':
+        def upload(hostname, username, password, data, remotePath, timeout):
+          # A second login and one transfer at the bandwidth of the channel
+          time.sleep(args.connect + 2 * args.latency)
+          if args.bandwidth:
+            time.sleep(float(len(data)) / args.bandwidth)
+          ssh.device.flash[remotePath] = data
+        module.scpUpload = upload
+        success = module.executeTransaction(ssh, '10.0.0.1', 'admin', 'admin', path,
+                                            'merge', 'flash:', 60)[0]
+      elif variant in ('pipeline', 'adaptive'):
+        ssh.command("terminal length 0")
+        if variant == 'adaptive':
+          module.state.pacer = module.commandPacer(args.window, adaptive=True)
+        success = module.executeCommandList(ssh, path, args.window, 60)
+        if variant == 'adaptive':
+          pacing = module.state.pacer.report()
+          module.state.pacer = None
+      else:
+        success = module.executeCommandList(ssh, path)
+      ssh.command("end")
+      elapsed = time.time() - start
+  finally:
+    os.unlink(path)
+
+  result = dict(suite='exec', variant=variant, lines=lines * 3 + 2, success=success,
+                wall=round(elapsed, 4), phases=timer.report(), peakMemory=memory.peak)
+  if variant == 'adaptive':
+    result['window'] = "%(minWindow)d-%(maxWindow)d" % pacing
+  result.update(factory.counters())
+  return result
+
+
+def benchRollout(args, lines, variant):
+  # args.devices routers configured one at a time, or by the rolling deployment
+  module = loadModule('exec')
+  factory = simFactory(dict(interfaces=0), args.latency, args.bandwidth, args.delay, args.connect)
+  module.openSession = factory
+  path = configurationFile(lines)
+  hosts = [dict(hostname='10.0.%d.%d' % (number // 250, number % 250 + 1), commandFile=path,
+                username='admin', password='admin', enable='admin', broker=None, pipeline=True,
+                window=args.window, timeout=60, timings=False, trace_file=None, transaction=None,
+                remote_dir='flash:', only_missing=False, config_cache=None, rate=0, adaptive=False)
+           for number in range(args.devices)]
+  try:
+    with memoryPeak() as memory:
+      start = time.time()
+      results, summary = module.rollingDeploy(hosts, 1 if variant == 'serial' else args.workers)
+      elapsed = time.time() - start
+  finally:
+    os.unlink(path)
+
+  result = dict(suite='rollout', variant=variant, lines=lines * 3 + 2,
+                success=summary['succeeded'] == len(hosts), wall=round(elapsed, 4),
+                phases=dict(p95=summary['latency']['p95']), peakMemory=memory.peak)
+  result.update(factory.counters())
+  return result
+
+
+def benchSerial(args, lines, variant):
+  module = loadModule('serial')
+  device = iossim.iosDevice(interfaces=0)
+  port = iossim.openConsole(device, args.latency, args.baudrate)
+  timer = phaseTimer()
+  timer.wrap(module, 'read_output', 'read')
+  path = configurationFile(lines)
+  try:
+    with memoryPeak() as memory:
+      start = time.time()
+      outcome = module.provision(dict(port=port, baudrate=9600), path, 8,
+                                 mode=variant, chunk_size=args.chunk)
+      elapsed = time.time() - start
+  finally:
+    os.unlink(path)
+
+  return dict(suite='serial', variant=variant, lines=lines * 3 + 2, success=outcome['success'],
+              wall=round(elapsed, 4), phases=timer.report(), peakMemory=memory.peak,
+              commands=device.commands)
+
+
+def runCase(queue, function, arguments):
+  try:
+    queue.put(('ok', function(*arguments)))
+  except Exception:
+    queue.put(('error', traceback.format_exc()))
+
+
+def isolated(function, *arguments):
+  # function(*arguments) in a new process, returns its result or raises
+  # RuntimeError with the traceback of the case
+  queue = multiprocessing.Queue()
+  process = multiprocessing.Process(target=runCase, args=(queue, function, arguments))
+  process.start()
+  while True:
+    try:
+      status, value = queue.get(timeout=1)
+      break
+    except Empty:
+      if not process.is_alive():
+        status, value = 'error', "Exited with code %s before returning" % process.exitcode
+        break
+  process.join()
+  if status == 'error':
+    raise RuntimeError(value)
+  return value
+
+
+def failed(result):
+  return bool(result.get('errors')) or result.get('success') is False or result.get('same') is False
+
+
+def printResult(result):
+  size = result.get('interfaces', result.get('lines'))
+  if 'parser' in result:
+    size = "%s:%s" % (result['parser'], size)
+  sys.stdout.write("%-7s %-9s %15s %9.4fs  %-44s %s\n" % (
+    result['suite'], result['variant'], size, result['wall'],
+    " ".join("%s=%.2fs" % item for item in sorted(result['phases'].items())),
+    " ".join("%s=%s" % (key, result[key])
+             for key in ('roundTrips', 'bytesReceived', 'commands', 'peakMemory', 'errors', 'success',
+                         'linesPerSecond', 'same', 'window')
+             if key in result)))
+  sys.stdout.flush()
+
+
+def sizes(text):
+  return [int(size) for size in text.split(',') if size]
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the cisco modules against simulated routers")
+  parser.add_argument('--suite', action='append',
+                      choices=['facts', 'offline', 'parsers', 'exec', 'rollout', 'serial'],
+                      help="Suites to run, all by default")
+  parser.add_argument('--devices', type=int, default=10, help="Routers gathered at once")
+  parser.add_argument('--workers', type=int, default=20)
+  parser.add_argument('--interfaces', default='100,1000', help="Comma separated sizes of show interfaces")
+  parser.add_argument('--vrfs', type=int, default=50)
+  parser.add_argument('--neighbors', type=int, default=20)
+  parser.add_argument('--lines', default='100', help="Comma separated sizes of the configuration, in interfaces")
+  parser.add_argument('--latency', type=float, default=0.02, help="Round trip seconds")
+  parser.add_argument('--bandwidth', type=int, default=0, help="Bytes per second, 0 for unlimited")
+  parser.add_argument('--delay', type=float, default=0.05, help="Seconds netlib waits between reads")
+  parser.add_argument('--connect', type=float, default=0.0, help="Seconds of every SSH login")
+  parser.add_argument('--parse-workers', type=int, default=multiprocessing.cpu_count(),
+                      help="Processes of the parse pool variant")
+  parser.add_argument('--window', type=int, default=50)
+  parser.add_argument('--line-cost', type=float, default=0.0, help="Seconds the router takes for every line")
+  parser.add_argument('--vty-buffer', type=int, default=0,
+                      help="Lines the router queues before every line costs ten times more, 0 for no limit")
+  parser.add_argument('--baudrate', type=int, default=0, help="Simulated console speed, 0 for unlimited")
+  parser.add_argument('--chunk', type=int, default=128)
+  parser.add_argument('--json', help="Write the results to this file")
+  args = parser.parse_args()
+
+  suites = args.suite or ['facts', 'offline', 'parsers', 'exec', 'rollout', 'serial']
+  results = []
+  failures = []
+
+  def run(function, *arguments):
+    try:
+      outcome = isolated(function, args, *arguments)
+    except RuntimeError as e:
+      failures.append(function.__name__)
+      sys.stderr.write("%s%r failed:\n%s\n" % (function.__name__, arguments, e))
+      return
+    for result in outcome if isinstance(outcome, list) else [outcome]:
+      results.append(result)
+      printResult(result)
+      if failed(result):
+        failures.append(function.__name__)
+        if 'error' in result:
+          sys.stderr.write("%s %s: %s: %s\n" % ((result['suite'], result['variant']) + tuple(result['error'])))
+
+  if 'facts' in suites:
+    for interfaces in sizes(args.interfaces):
+      scale = dict(interfaces=interfaces, vrfs=args.vrfs, neighbors=args.neighbors)
+      for variant in ('legacy', 'burst', 'brief', 'pool'):
+        run(benchFacts, scale, variant)
+
+  if 'offline' in suites:
+    for interfaces in sizes(args.interfaces):
+      scale = dict(interfaces=interfaces, vrfs=args.vrfs, neighbors=args.neighbors)
+      for variant in ('threads', 'processes'):
+        run(benchOffline, scale, variant)
+
+  if 'parsers' in suites:
+    for interfaces in sizes(args.interfaces):
+      scale = dict(interfaces=interfaces, vrfs=args.vrfs, neighbors=args.neighbors)
+      run(benchParsers, scale)
+
+  if 'exec' in suites:
+    for lines in sizes(args.lines):
+      for variant in ('legacy', 'pipeline', 'adaptive', 'transaction'):
+        run(benchExec, lines, variant)
+
+  if 'rollout' in suites:
+    for lines in sizes(args.lines):
+      for variant in ('serial', 'rolling'):
+        run(benchRollout, lines, variant)
+
+  if 'serial' in suites:
+    for lines in sizes(args.lines):
+      for variant in ('line', 'bulk'):
+        run(benchSerial, lines, variant)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if failures:
+    sys.stderr.write("%d cases failed\n" % len(failures))
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,645 @@
+#! /usr/bin/python
+
+# Copyright 2016 Antonio Arriaga Diaz <antonio.arriaga.diaz@gmail.com >
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Simulated Cisco IOS router for the benchmarks of the cisco modules.
+#
+# iosDevice answers show commands with generated outputs whose size is set
+# by the number of interfaces, VRFs and BGP neighbors, and keeps a small
+# running-config changed by configuration commands. It can be reached:
+#
+#   - in process, with simSSH, a netlib SSH look-alike whose channel adds a
+#     round trip latency and a bandwidth limit,
+#   - over SSH, with serveSSH (needs paramiko), accepting any password,
+#   - as a serial console, with openConsole, on a pseudo terminal.
+#
+#   python iossim.py ssh --port 2222 --interfaces 1000
+#   python iossim.py serial --interfaces 100
+
+import os
+import re
+import sys
+import time
+import socket
+import argparse
+import threading
+import collections
+
+
+# First words of the configuration commands that enter a sub mode
+SECTIONS = [
+  ('interface ', 'config-if'),
+  ('ip vrf ', 'config-vrf'),
+  ('vrf definition ', 'config-vrf'),
+  ('router ', 'config-router'),
+  ('line ', 'config-line'),
+  ('address-family ', 'config-router-af'),
+]
+# Interface commands that look like the ip vrf section
+INTERFACE_VRF = ("ip vrf forwarding ", "ip vrf receive ")
+
+
+def toText(data):
+  if isinstance(data, bytes) and not isinstance(data, str):
+    return data.decode('utf-8', 'ignore')
+  return data
+
+
+def crlf(lines):
+  return "".join(line + "\r\n" for line in lines)
+
+
+class iosDevice(object):
+  def __init__(self, hostname='CISCOROUTER', interfaces=16, vrfs=4, neighbors=2,
+               AS='65010', errorPattern=r'^bad\b'):
+    self.hostname = hostname
+    self.interfaces = interfaces
+    self.vrfs = vrfs
+    self.neighbors = neighbors
+    self.AS = AS
+    self.errorPattern = re.compile(errorPattern)
+    self.mode = 'exec'
+    self.section = None
+    self.subsection = None
+    self.lastChange = "! No configuration change since last restart"
+    self.commands = 0
+    self.flash = {}
+    self.question = None
+    self.config = collections.OrderedDict()
+    self.outputs = {}
+    self.buildConfig()
+
+  # Generated data
+
+  def subinterface(self, number):
+    return "GigabitEthernet0/0.%d" % (100 + number)
+
+  def subinterfaceIP(self, number):
+    return "172.%d.%d.1" % (16 + number // 65536, (number // 256) % 256) if number >= 65536 \
+      else "172.16.%d.%d" % (number // 250, number % 250 + 1)
+
+  def buildConfig(self):
+    self.config["hostname " + self.hostname] = []
+    for number in range(self.vrfs):
+      self.config["ip vrf V%d" % number] = [
+        " rd %s:%d" % (self.AS, 100 + number),
+        " route-target export %s:%d" % (self.AS, 100 + number),
+        " route-target import %s:%d" % (self.AS, 100 + number)]
+    self.config["interface Loopback0"] = [" ip address 10.0.0.1 255.255.255.255"]
+    self.config["interface GigabitEthernet0/0"] = [" ip address 172.16.16.183 255.255.255.0"]
+    self.config["interface GigabitEthernet0/1"] = [" no ip address", " shutdown"]
+    for number in range(self.interfaces):
+      children = [" encapsulation dot1Q %d" % (100 + number)]
+      if number < self.vrfs:
+        children.append(" ip vrf forwarding V%d" % number)
+      children.append(" ip address %s 255.255.255.0" % self.subinterfaceIP(number))
+      self.config["interface " + self.subinterface(number)] = children
+    bgp = [" bgp router-id 172.16.16.183"]
+    for number in range(self.neighbors):
+      bgp.append(" neighbor %s remote-as %s" % (self.neighborIP(number), self.AS))
+    self.config["router bgp " + self.AS] = bgp
+    self.config["line con 0"] = [" speed 9600"]
+
+  def neighborIP(self, number):
+    return "10.1.%d.%d" % (number // 250, number % 250 + 1)
+
+  def interfaceBlocks(self):
+    yield [
+      "GigabitEthernet0/0 is up, line protocol is up ",
+      "  Hardware is BCM1250 Internal MAC, address is 0016.9c98.3c1b (bia 0016.9c98.3c1b)",
+      "  Internet address is 172.16.16.183/24",
+      "  MTU 1500 bytes, BW 1000000 Kbit/sec, DLY 10 usec, ",
+      "     reliability 255/255, txload 1/255, rxload 1/255",
+      "  Encapsulation 802.1Q Virtual LAN, Vlan ID  1., loopback not set",
+      "  Keepalive set (10 sec)"]
+    yield [
+      "GigabitEthernet0/1 is administratively down, line protocol is down ",
+      "  Hardware is BCM1250 Internal MAC, address is 0016.9c98.3c1a (bia 0016.9c98.3c1a)",
+      "  MTU 1500 bytes, BW 1000000 Kbit/sec, DLY 10 usec, ",
+      "  Encapsulation ARPA, loopback not set"]
+    yield [
+      "Loopback0 is up, line protocol is up ",
+      "  Hardware is Loopback",
+      "  Internet address is 10.0.0.1/32",
+      "  MTU 1514 bytes, BW 8000000 Kbit/sec, DLY 5000 usec, ",
+      "  Encapsulation LOOPBACK, loopback not set"]
+    for number in range(self.interfaces):
+      yield [
+        "%s is up, line protocol is up " % self.subinterface(number),
+        "  Hardware is BCM1250 Internal MAC, address is 0016.9c98.3c1b (bia 0016.9c98.3c1b)",
+        "  Internet address is %s/24" % self.subinterfaceIP(number),
+        "  MTU 1500 bytes, BW 1000000 Kbit/sec, DLY 10 usec, ",
+        "     reliability 255/255, txload 1/255, rxload 1/255",
+        "  Encapsulation 802.1Q Virtual LAN, Vlan ID  %d., loopback not set" % (100 + number),
+        "  ARP type: ARPA, ARP Timeout 04:00:00",
+        "  Last input 00:00:01, output 00:00:00, output hang never",
+        "  Last clearing of \"show interface\" counters never",
+        "     0 packets input, 0 bytes, 0 no buffer",
+        "     0 packets output, 0 bytes, 0 underruns"]
+
+  def showInterfaces(self, name=None):
+    lines = []
+    for block in self.interfaceBlocks():
+      if name is None or block[0].startswith(name + " "):
+        lines.extend(block)
+    return crlf(lines)
+
+  def showBrief(self):
+    lines = ["Interface                  IP-Address      OK? Method Status                Protocol",
+             "GigabitEthernet0/0         172.16.16.183   YES NVRAM  up                    up      ",
+             "GigabitEthernet0/1         unassigned      YES NVRAM  administratively down down    ",
+             "Loopback0                  10.0.0.1        YES NVRAM  up                    up      "]
+    for number in range(self.interfaces):
+      lines.append("%-26s %-15s YES NVRAM  up                    up      "
+                   % (self.subinterface(number), self.subinterfaceIP(number)))
+    return crlf(lines)
+
+  def showDescription(self):
+    lines = ["Interface                      Status         Protocol Description",
+             "Gi0/0                          up             up       Uplink",
+             "Gi0/1                          admin down     down     ",
+             "Lo0                            up             up       Router ID"]
+    for number in range(self.interfaces):
+      lines.append("%-30s up             up       customer %d" % ("Gi0/0.%d" % (100 + number), number))
+    return crlf(lines)
+
+  def showVrf(self):
+    lines = ["  Name                             Default RD          Interfaces"]
+    for number in range(self.vrfs):
+      lines.append("  %-32s %-19s %s" % ("V%d" % number, "%s:%d" % (self.AS, 100 + number), "Lo%d" % (100 + number)))
+      lines.append("  %-32s %-19s %s" % ("", "", "Gi0/0.%d" % (100 + number)))
+    return crlf(lines)
+
+  def showBgpSummary(self):
+    lines = ["BGP router identifier 172.16.16.183, local AS number %s" % self.AS,
+             "BGP table version is 9, main routing table version 9", "",
+             "Neighbor        V    AS MsgRcvd MsgSent   TblVer  InQ OutQ Up/Down  State/PfxRcd"]
+    for number in range(self.neighbors):
+      lines.append("%-15s 4 %s     100     100        9    0    0 01:00:00        0"
+                   % (self.neighborIP(number), self.AS))
+    return crlf(lines)
+
+  def showRd(self):
+    return crlf(["Route Distinguisher: %s:%d (default for vrf V%d)" % (self.AS, 100 + number, number)
+                 for number in range(self.vrfs)])
+
+  def showVersion(self):
+    return crlf(["Cisco IOS Software, 1841 Software (C1841-ADVENTERPRISEK9-M), Version 12.4(20)T1",
+                 "ROM: System Bootstrap, Version 12.4(13r)T, RELEASE SOFTWARE (fc1)",
+                 "",
+                 'System image file is "flash:c1841-adventerprisek9-mz.124-20.T1.bin"',
+                 ""])
+
+  def runningConfig(self):
+    lines = ["Building configuration...", "", "Current configuration : 1024 bytes", "!",
+             self.lastChange, "!", "version 12.4"]
+    for parent, children in self.config.items():
+      lines.append(parent)
+      lines.extend(children)
+      lines.append("!")
+    lines.append("end")
+    return lines
+
+  # Flash and configuration files
+
+  def ask(self, question, answer):
+    self.question = answer
+    return question
+
+  def copy(self, source, destination):
+    if source == "running-config" and destination.startswith("flash:"):
+      def save(answer):
+        self.flash[destination] = crlf(self.runningConfig())
+        return "Building configuration...\r\n[OK]\r\n"
+      def overwrite(answer):
+        if destination in self.flash:
+          return self.ask("%Warning:There is a file already existing with this name \r\n"
+                          "Do you want to over write? [confirm]", save)
+        return save(answer)
+      return self.ask("Destination filename [%s]? " % destination[6:], overwrite)
+
+    if destination == "running-config":
+      if source not in self.flash:
+        return "%%Error opening %s (No such file or directory)\r\n" % source
+      def merge(answer):
+        errors = self.merge(self.flash[source])
+        return errors + "%d bytes copied in 0.052 secs (9596 bytes/sec)\r\n" % len(self.flash[source])
+      return self.ask("Destination filename [running-config]? ", merge)
+
+    return "%Error: copy not simulated\r\n"
+
+  def merge(self, text):
+    # Lines applied in configuration mode, only the errors are shown
+    self.mode = 'config'
+    errors = ""
+    for line in text.splitlines():
+      if line.strip() == "end":
+        break
+      output = self.execute(line)
+      if "% " in output:
+        errors += line.strip() + "\r\n" + output
+    self.mode = 'exec'
+    self.section = self.subsection = None
+    return errors
+
+  def replace(self, name):
+    if name not in self.flash:
+      return "%%Error opening %s (No such file or directory)\r\n" % name
+    config = collections.OrderedDict()
+    children = None
+    for line in self.flash[name].splitlines():
+      if (not line.strip() or line.startswith("!") or line in ("end", "Building configuration...")
+          or line.startswith("Current configuration") or line.startswith("version ")):
+        continue
+      if line[0] != " ":
+        children = config.setdefault(line, [])
+        if line.startswith("hostname "):
+          self.hostname = line.split()[1]
+      elif children is not None:
+        children.append(line)
+    self.config = config
+    self.lastChange = time.strftime("! Last configuration change at %H:%M:%S UTC %a %b %d %Y by admin")
+    return "Total number of passes: 1\r\nRollback Done\r\n\r\n"
+
+  # Command interpreter
+
+  def prompt(self):
+    if self.question is not None:
+      # Waiting for the answer of a question, not at the prompt
+      return ""
+    if self.mode == 'exec':
+      return self.hostname + "#"
+    return "%s(%s)#" % (self.hostname, self.mode)
+
+  def execute(self, line):
+    """Output of line, without its echo and without the next prompt"""
+    self.commands += 1
+    command = line.strip()
+    if self.question is not None:
+      answer, self.question = self.question, None
+      return answer(command)
+    if not command or command.startswith("!"):
+      return ""
+    if self.errorPattern.search(command):
+      return "       ^\r\n% Invalid input detected at '^' marker.\r\n\r\n"
+    if self.mode == 'exec':
+      return self.executeExec(command)
+    return self.executeConfig(command)
+
+  def executeExec(self, command):
+    if command in ("terminal length 0", "enable", "end", "exit"):
+      return ""
+    if command in ("configure terminal", "conf t"):
+      self.mode = 'config'
+      return "Enter configuration commands, one per line.  End with CNTL/Z.\r\n"
+    if command.startswith("copy "):
+      return self.copy(*command.split()[1:3])
+    if command.startswith("configure replace "):
+      return self.replace(command.split()[2])
+    if command.startswith("delete "):
+      name = command.split()[-1]
+      if self.flash.pop(name, None) is None:
+        return "%%Error deleting %s (No such file or directory)\r\n" % name
+      return ""
+
+    show, _, include = command.partition(" | inc ")
+    if show in ("show running-config", "show run"):
+      lines = self.runningConfig()
+      if include:
+        pattern = re.compile(include.replace("include ", ""))
+        lines = [line for line in lines if pattern.search(line)]
+      return crlf(lines)
+
+    outputs = {
+      "show ip bgp summary": self.showBgpSummary,
+      "show ip bgp vpnv4 all | inc Route Distinguisher": self.showRd,
+      "show version": self.showVersion,
+      "show interfaces": self.showInterfaces,
+      "show ip interface brief": self.showBrief,
+      "show interfaces description": self.showDescription,
+      "show ip vrf": self.showVrf,
+    }
+    if command in outputs:
+      return outputs[command]()
+    if command.startswith("show interfaces "):
+      return self.showInterfaces(command[len("show interfaces "):])
+    return "       ^\r\n% Invalid input detected at '^' marker.\r\n\r\n"
+
+  def executeConfig(self, command):
+    if command == "end":
+      self.mode = 'exec'
+      self.section = self.subsection = None
+      return ""
+    if command == "exit-address-family" or (command == "exit" and self.subsection):
+      self.mode = 'config-router'
+      self.subsection = None
+      return ""
+    if command == "exit":
+      self.mode = 'config'
+      self.section = None
+      return ""
+
+    self.lastChange = time.strftime("! Last configuration change at %H:%M:%S UTC %a %b %d %Y by admin")
+    if command.startswith("hostname "):
+      del self.config["hostname " + self.hostname]
+      self.hostname = command.split()[1]
+      self.config["hostname " + self.hostname] = []
+      return ""
+
+    for keyword, mode in SECTIONS:
+      if command.startswith(keyword) and not command.startswith(INTERFACE_VRF):
+        if keyword == 'address-family ' and self.section:
+          self.subsection = " " + command
+          self.mode = mode
+          if self.subsection not in self.config[self.section]:
+            self.config[self.section].extend([self.subsection, "  exit-address-family"])
+          return ""
+        self.section = command
+        self.subsection = None
+        self.mode = mode
+        self.config.setdefault(command, [])
+        return ""
+
+    if self.section is None:
+      self.config.setdefault(command, [])
+    elif self.subsection:
+      children = self.config[self.section]
+      child = "  " + command
+      if child not in children:
+        children.insert(children.index(self.subsection) + 1, child)
+    else:
+      children = self.config[self.section]
+      if command.startswith("no "):
+        children[:] = [child for child in children if not child.strip().startswith(command[3:])]
+      if " " + command not in children:
+        children.append(" " + command)
+    return ""
+
+
+class simChannel(object):
+  """Paramiko channel look-alike in front of an iosDevice.
+
+  Output of a line becomes readable latency seconds after the line is sent,
+  then at bandwidth bytes per second. Every line takes lineCost seconds of
+  the router, ten times more when more than buffer lines wait before it.
+  Counters are kept for the benchmarks."""
+  def __init__(self, device, latency=0.0, bandwidth=0, lineCost=0.0, buffer=0):
+    self.device = device
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.lineCost = lineCost
+    self.buffer = buffer
+    self.queue = collections.deque()
+    self.ready = time.time()
+    self.sends = 0
+    self.bytesSent = 0
+    self.bytesReceived = 0
+    self.pending = ""
+    self.lock = threading.Lock()
+    self.push(device.prompt())
+
+  def push(self, text, cost=0.0):
+    # Output is sent in order, after the latency and the previous output
+    now = time.time()
+    start = max(now + self.latency, self.ready) + cost
+    duration = float(len(text)) / self.bandwidth if self.bandwidth else 0
+    self.ready = start + duration
+    self.queue.append([start, duration, text])
+
+  def sendall(self, data):
+    with self.lock:
+      self.sends += 1
+      self.bytesSent += len(data)
+      # Only complete lines are executed, the rest waits for its newline
+      lines = (self.pending + toText(data)).split("\n")
+      self.pending = lines.pop()
+      for line in lines:
+        line = line.rstrip("\r")
+        output = self.device.execute(line)
+        cost = self.lineCost
+        if self.buffer and len([entry for entry in self.queue if entry[0] > time.time()]) > self.buffer:
+          cost *= 10
+        self.push(line + "\r\n" + output + self.device.prompt(), cost)
+
+  def available(self):
+    # Characters of the head of the queue already received
+    if not self.queue:
+      return 0
+    start, duration, text = self.queue[0]
+    now = time.time()
+    if now < start:
+      return 0
+    if not duration or now >= start + duration:
+      return len(text)
+    return int(len(text) * (now - start) / duration)
+
+  def recv_ready(self):
+    with self.lock:
+      return self.available() > 0
+
+  def recv(self, size):
+    with self.lock:
+      data = ""
+      while self.queue and len(data) < size:
+        count = min(self.available(), size - len(data))
+        if not count:
+          break
+        entry = self.queue[0]
+        data += entry[2][:count]
+        if count == len(entry[2]):
+          self.queue.popleft()
+        else:
+          elapsed = float(count) / self.bandwidth if self.bandwidth else 0
+          entry[0] += elapsed
+          entry[1] = max(0, entry[1] - elapsed)
+          entry[2] = entry[2][count:]
+      self.bytesReceived += len(data)
+      return data.encode('utf-8')
+
+  def close(self):
+    pass
+
+
+class simSSH(object):
+  """netlib SSH look-alike on a simChannel.
+
+  command() waits delay seconds between reads like netlib does, and connect()
+  takes connectTime seconds, the cost of the SSH handshake and login."""
+  def __init__(self, device, latency=0.0, bandwidth=0, delay=1.0, connectTime=0.0,
+               lineCost=0.0, buffer=0):
+    self.device = device
+    self.client_conn = simChannel(device, latency, bandwidth, lineCost, buffer)
+    self.delay = delay
+    self.connectTime = connectTime
+    self.commands = 0
+
+  def connect(self):
+    time.sleep(self.connectTime)
+    time.sleep(self.client_conn.latency)
+    return self.recvAll()
+
+  def recvAll(self):
+    output = ""
+    while self.client_conn.recv_ready():
+      output += self.client_conn.recv(65535).decode('utf-8')
+    return output
+
+  def set_enable(self, enable):
+    return self.command("\n")
+
+  def command(self, command):
+    self.commands += 1
+    self.client_conn.sendall(command + "\n")
+    output = ""
+    while True:
+      time.sleep(self.delay)
+      if self.client_conn.recv_ready():
+        output += self.recvAll()
+      else:
+        return output
+
+  def close(self):
+    pass
+
+
+def serveLines(read, write, device, latency=0.0, newline="\r"):
+  # Echo every line, then its output and the prompt, like a console or VTY
+  write(device.prompt())
+  pending = ""
+  while True:
+    data = read()
+    if not data:
+      return
+    pending += data
+    while True:
+      end = min([position for position in (pending.find("\r"), pending.find("\n")) if position >= 0] or [-1])
+      if end < 0:
+        break
+      line = pending[:end]
+      pending = pending[end + 1:]
+      if newline == "\r" and pending.startswith("\n"):
+        pending = pending[1:]
+      output = device.execute(line)
+      if latency:
+        time.sleep(latency)
+      write(line + "\r\n" + output + device.prompt())
+
+
+def openConsole(device, latency=0.0, baudrate=0):
+  """Serial console on a pseudo terminal, returns the path to open"""
+  import tty
+  master, slave = os.openpty()
+  tty.setraw(slave)
+  tty.setraw(master)
+
+  def read():
+    return os.read(master, 4096).decode('utf-8', 'ignore')
+
+  def write(text):
+    data = text.encode('utf-8')
+    if baudrate:
+      # 10 bits per character with start and stop bits
+      time.sleep(len(data) * 10.0 / baudrate)
+    os.write(master, data)
+
+  thread = threading.Thread(target=serveLines, args=(read, write, device, latency))
+  thread.daemon = True
+  thread.start()
+  return os.ttyname(slave)
+
+
+def serveSSH(deviceFactory, port=2222, address='127.0.0.1', latency=0.0, hostKey=None):
+  """SSH server accepting any user and password, one device per connection"""
+  import paramiko
+
+  if hostKey is None:
+    hostKey = paramiko.RSAKey.generate(2048)
+
+  class server(paramiko.ServerInterface):
+    def __init__(self):
+      self.shell = threading.Event()
+
+    def check_channel_request(self, kind, chanid):
+      if kind == 'session':
+        return paramiko.OPEN_SUCCEEDED
+      return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_auth_password(self, username, password):
+      return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+      return 'password'
+
+    def check_channel_shell_request(self, channel):
+      self.shell.set()
+      return True
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+      return True
+
+  def handle(client):
+    transport = paramiko.Transport(client)
+    transport.add_server_key(hostKey)
+    interface = server()
+    transport.start_server(server=interface)
+    channel = transport.accept(30)
+    if channel is None:
+      return
+    interface.shell.wait(10)
+
+    def read():
+      return channel.recv(4096).decode('utf-8', 'ignore')
+
+    serveLines(read, channel.sendall, deviceFactory(), latency)
+    transport.close()
+
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.bind((address, port))
+  listener.listen(100)
+  while True:
+    client, peer = listener.accept()
+    thread = threading.Thread(target=handle, args=(client,))
+    thread.daemon = True
+    thread.start()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulated Cisco IOS router")
+  parser.add_argument('endpoint', choices=['ssh', 'serial'])
+  parser.add_argument('--port', type=int, default=2222, help="SSH port")
+  parser.add_argument('--interfaces', type=int, default=16)
+  parser.add_argument('--vrfs', type=int, default=4)
+  parser.add_argument('--neighbors', type=int, default=2)
+  parser.add_argument('--latency', type=float, default=0.0, help="Seconds before every answer")
+  parser.add_argument('--baudrate', type=int, default=0, help="Console speed, 0 for unlimited")
+  args = parser.parse_args()
+
+  def factory():
+    return iosDevice(interfaces=args.interfaces, vrfs=args.vrfs, neighbors=args.neighbors)
+
+  if args.endpoint == 'ssh':
+    sys.stdout.write("Listening on 127.0.0.1:%d\n" % args.port)
+    sys.stdout.flush()
+    serveSSH(factory, args.port, latency=args.latency)
+  else:
+    sys.stdout.write("Console on %s\n" % openConsole(factory(), args.latency, args.baudrate))
+    sys.stdout.flush()
+    while True:
+      time.sleep(3600)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
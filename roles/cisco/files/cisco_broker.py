@@ -0,0 +1,266 @@
+#! /usr/bin/python
+
+# Copyright 2016 Antonio Arriaga Diaz <antonio.arriaga.diaz@gmail.com >
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Connection broker for the cisco modules.
+#
+# Keeps authenticated and enabled netlib SSH sessions alive, keyed by
+# hostname/username, and lends them to cisco_gather_facts and
+# cisco_exec_commands over a Unix socket. Sessions not used for --idle
+# seconds are closed.
+#
+#   python cisco_broker.py --socket /tmp/cisco_broker.sock --idle 300 &
+#
+# Protocol: one JSON request per line, one JSON reply per line. The first
+# request of a connection must be "open"; the session stays borrowed by that
+# connection until it is closed.
+#
+#   {"op": "open", "hostname": ..., "username": ..., "password": ..., "enable": ...}
+#   {"op": "command", "command": "show version"}
+#   {"op": "send", "data": "show version\n"}
+#   {"op": "recv", "timeout": 0.05}
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+
+try:
+  import SocketServer as socketserver
+except ImportError:
+  import socketserver
+
+from netlib.conn_type import SSH
+
+
+DEFAULT_SOCKET = '/tmp/cisco_broker.sock'
+DEFAULT_IDLE = 300
+
+
+PROMPT_END = re.compile(r"(?:^|\n)[\w.\-/]+(?:\([\w.\-/ ]+\))?[>#]\s*$")
+
+
+class brokerSession(object):
+  def __init__(self, hostname, username):
+    self.hostname = hostname
+    self.username = username
+    self.password = None
+    self.enable = None
+    self.ssh = None
+    self.lock = threading.Lock()
+    self.lastUsed = time.time()
+
+  def alive(self):
+    if self.ssh is None:
+      return False
+    transport = self.ssh.pre_conn.get_transport()
+    return transport is not None and transport.is_active()
+
+  def open(self, password, enable):
+    self.close()
+    self.password = password
+    self.enable = enable
+    ssh = SSH(self.hostname, self.username, password)
+    ssh.connect()
+    ssh.set_enable(enable)
+    ssh.command("terminal length 0")
+    self.ssh = ssh
+
+  def recv(self, timeout):
+    # Whatever the router has sent, waiting at most timeout seconds for it
+    channel = self.ssh.client_conn
+    deadline = time.time() + timeout
+    while not channel.recv_ready() and time.time() < deadline:
+      time.sleep(0.01)
+    output = b''
+    while channel.recv_ready():
+      output += channel.recv(65535)
+    return output.decode('utf-8', 'ignore')
+
+  def reset(self, timeout=5):
+    # Back to the exec prompt with nothing left to read, whatever the last
+    # client left: configuration mode, output it did not read
+    self.ssh.client_conn.sendall("end\n")
+    deadline = time.time() + timeout
+    output = ''
+    while time.time() < deadline:
+      output += self.recv(deadline - time.time())
+      echo = output.rfind("end")
+      if echo >= 0 and PROMPT_END.search(output[echo:]):
+        return
+    raise IOError("No prompt after end from " + self.hostname)
+
+  def close(self):
+    if self.ssh is not None:
+      try:
+        self.ssh.close()
+      except Exception:
+        pass
+    self.ssh = None
+
+
+class sessionPool(object):
+  def __init__(self, idleTimeout):
+    self.idleTimeout = idleTimeout
+    self.sessions = {}
+    self.lock = threading.Lock()
+
+  def borrow(self, hostname, username, password, enable):
+    key = (hostname, username)
+    while True:
+      with self.lock:
+        if key not in self.sessions:
+          self.sessions[key] = brokerSession(hostname, username)
+        session = self.sessions[key]
+
+      session.lock.acquire()
+      with self.lock:
+        # evict may have dropped it before it was locked, a session opened
+        # outside the pool would never be closed
+        if self.sessions.get(key) is session:
+          break
+      session.lock.release()
+
+    try:
+      # A session is only handed out to a client that knows its credentials
+      if (not session.alive() or session.password != password
+          or session.enable != enable):
+        session.open(password, enable)
+    except Exception:
+      session.close()
+      session.lock.release()
+      raise
+    return session
+
+  def release(self, session):
+    try:
+      if session.alive():
+        session.reset()
+    except Exception:
+      # Opened again by the next borrow
+      session.close()
+    session.lastUsed = time.time()
+    session.lock.release()
+
+  def evict(self):
+    now = time.time()
+    with self.lock:
+      for key in list(self.sessions):
+        session = self.sessions[key]
+        if not session.lock.acquire(False):
+          continue
+        try:
+          if now - session.lastUsed > self.idleTimeout or not session.alive():
+            session.close()
+            del self.sessions[key]
+        finally:
+          session.lock.release()
+
+  def closeAll(self):
+    with self.lock:
+      for session in self.sessions.values():
+        session.close()
+      self.sessions = {}
+
+
+class brokerHandler(socketserver.StreamRequestHandler):
+  def reply(self, **reply):
+    self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+    self.wfile.flush()
+
+  def handle(self):
+    pool = self.server.pool
+    session = None
+    try:
+      for line in self.rfile:
+        request = json.loads(line.decode('utf-8'))
+        op = request.get('op')
+        try:
+          if op == 'open' and session is None:
+            session = pool.borrow(request['hostname'], request['username'],
+                                  request['password'], request['enable'])
+            self.reply(ok=True)
+          elif session is None:
+            self.reply(error="Session not opened")
+          elif op == 'command':
+            self.reply(ok=True, output=session.ssh.command(request['command']))
+          elif op == 'send':
+            session.ssh.client_conn.sendall(request['data'])
+            self.reply(ok=True)
+          elif op == 'recv':
+            self.reply(ok=True, output=session.recv(min(float(request.get('timeout', 0)), 5)))
+          else:
+            self.reply(error="Unknown operation: " + str(op))
+        except Exception as e:
+          if session is not None:
+            session.close()
+          self.reply(error=str(e))
+    finally:
+      if session is not None:
+        pool.release(session)
+
+
+class brokerServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socketPath, pool):
+    self.pool = pool
+    socketserver.ThreadingUnixStreamServer.__init__(self, socketPath, brokerHandler)
+
+
+def evictLoop(pool, interval):
+  while True:
+    time.sleep(interval)
+    pool.evict()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Keep Cisco SSH sessions alive for the cisco modules")
+  parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Unix socket path")
+  parser.add_argument('--idle', type=int, default=DEFAULT_IDLE, help="Seconds before an idle session is closed")
+  args = parser.parse_args()
+
+  if os.path.exists(args.socket):
+    os.unlink(args.socket)
+
+  pool = sessionPool(args.idle)
+  # Sessions hold router credentials, only the owner may borrow them. The
+  # socket is created 0600, a chmod after bind would leave it open a moment
+  umask = os.umask(0o177)
+  try:
+    server = brokerServer(args.socket, pool)
+  finally:
+    os.umask(umask)
+
+  evictor = threading.Thread(target=evictLoop, args=(pool, max(1, args.idle // 10)))
+  evictor.daemon = True
+  evictor.start()
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    pool.closeAll()
+    server.server_close()
+    os.unlink(args.socket)
+
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -21,13 +21,28 @@ short_description: Execute all lines from a file in a Cisco IOS router
 description:
     - Execute all lines from a file in a Cisco IOS router.
     - If a line execution return an error, the module will fail.
+    - With pipeline, lines are sent in windows without waiting for the prompt
+      of every line. Errors are still reported with the failing line, but up
+      to window-1 lines following it may have been applied already.
+    - With transaction, the file is uploaded with SCP and applied at once.
+      The running-config is saved to remote_dir first and restored with
+      configure replace when the router reports an error, so the router is
+      never left half configured.
+    - With only_missing, or in check mode, the running-config is read once
+      and compared, section by section (ip vrf, interface, router bgp and its
+      address-families...), with commandFile. Only the sections with a
+      missing line, sent whole, and the missing top level lines are applied.
+      Check mode returns them in commands without applying anything.
+    - With hosts, the routers are configured in waves by threads of this
+      module instead of one Ansible process per router. The result of every
+      router is returned in hosts and their latencies in summary.
 author: Antonio Arriaga Diaz
 version_added: 1.0
 options:
   hostname:
     description:
-      - Hostame or IP address of router.
-    required: true
+      - Hostame or IP address of router. Required unless hosts is used.
+    required: false
   username:
     description:
       - Username used to login to the router
@@ -42,85 +57,1235 @@ options:
     required: true
   commandFile:
     description:
-      - File that contains all Cisco commands
-    required: true
+      - File that contains all Cisco commands. Required with hostname.
+    required: false
+  broker:
+    description:
+      - Unix socket of a running cisco_broker. When the socket exists the
+        session is borrowed from the broker instead of opening a new SSH
+        connection.
+    required: false
+    default: "/tmp/cisco_broker.sock"
+  pipeline:
+    description:
+      - Send the lines of commandFile in windows instead of waiting for the
+        prompt after every line.
+    required: false
+    default: false
+  window:
+    description:
+      - Number of lines sent before reading their output when pipeline is used.
+    required: false
+    default: 50
+  timeout:
+    description:
+      - Seconds to wait for the output of a window when pipeline is used.
+    required: false
+    default: 60
+  timings:
+    description:
+      - Return in timings the connection and enable time, the number of
+        round trips and bytes received, and the 10 slowest lines (or windows
+        with pipeline). With rate, global_rate or adaptive, pacing has the
+        seconds waited for the rate limits and the windows used.
+    required: false
+    default: false
+  trace_file:
+    description:
+      - Append the timings of the run, with the round trip of every line, to
+        this file as one JSON object per line.
+    required: false
+  transaction:
+    description:
+      - merge copies the uploaded file to the running-config, replace makes
+        it the whole running-config with configure replace. The
+        enable/configure terminal/end lines of commandFile are left out of
+        the upload. Needs "ip scp server enable" and a privilege 15 user.
+    required: false
+    choices: ["merge", "replace"]
+  remote_dir:
+    description:
+      - Router file system where the file and the checkpoint of the
+        running-config are written while the transaction lasts.
+    required: false
+    default: "flash:"
+  only_missing:
+    description:
+      - Send only the lines of commandFile missing from the running-config.
+        A section with a missing line is sent whole, as the order of its
+        lines matters. Always used in check mode. Not allowed with
+        transaction=replace, which needs the whole configuration.
+    required: false
+    default: false
+  config_cache:
+    description:
+      - Directory where the running-config of every router is kept for
+        only_missing. The copy is used while the router reports the same
+        last configuration change, and dropped once lines are applied.
+    required: false
+  hosts:
+    description:
+      - List of routers to configure in a rolling deployment. Every item has
+        a hostname and a commandFile, and may override any other option
+        (username, password, enable, transaction...) for its router, except
+        concurrency, wave_size, max_fail_percentage and global_rate.
+    required: false
+  concurrency:
+    description:
+      - Maximum number of routers configured at the same time with hosts.
+    required: false
+    default: 20
+  wave_size:
+    description:
+      - Number of routers of every wave with hosts. A wave starts when the
+        previous one is over. 0 deploys all the routers in a single wave.
+    required: false
+    default: 0
+  max_fail_percentage:
+    description:
+      - Percentage of the routers of a wave that may fail before the next
+        waves are skipped.
+    required: false
+    default: 0
+  rate:
+    description:
+      - Maximum lines per second sent to a router, 0 for no limit. Can be
+        set for every item of hosts, for the routers that cannot keep up.
+        With pipeline, windows are at most rate lines.
+    required: false
+    default: 0
+  global_rate:
+    description:
+      - Maximum lines per second sent to all the routers of hosts together,
+        0 for no limit. With pipeline, windows are at most global_rate
+        lines.
+    required: false
+    default: 0
+  adaptive:
+    description:
+      - With pipeline, start with windows of 4 lines and adjust the window
+        of every router to its response time. It grows while the seconds per
+        line stay close to the best seen, and is halved when they double.
+        window is the largest window used.
+    required: false
+    default: false
 '''
 
 EXAMPLES = '''
 - cisco_exec_commands: hostname=10.1.1.100 username=admin password=123456 enable=987654 commandFile="/path/to/file/commandFile"
+- cisco_exec_commands: hostname=10.1.1.100 username=admin password=123456 enable=987654 commandFile="/path/to/file/commandFile" pipeline=yes window=100
+- cisco_exec_commands: hostname=10.1.1.100 username=admin password=123456 enable=987654 commandFile="/path/to/file/commandFile" timings=yes trace_file=/var/log/cisco_timings.jsonl
+- cisco_exec_commands: hostname=10.1.1.100 username=admin password=123456 enable=987654 commandFile="/path/to/file/commandFile" transaction=merge
+- cisco_exec_commands: hostname=10.1.1.100 username=admin password=123456 enable=987654 commandFile="/path/to/file/commandFile" only_missing=yes config_cache=/var/cache/cisco
+
+# addVRF on every BRAS, 10 routers at a time in waves of 50, stopping after a wave with more than 10% failures
+- local_action:
+    module: cisco_exec_commands
+    username: admin
+    password: 123456
+    enable: 987654
+    transaction: merge
+    concurrency: 10
+    wave_size: 50
+    max_fail_percentage: 10
+    hosts:
+      - { hostname: bras1, commandFile: /path/to/bras1/addVRF }
+      - { hostname: bras2, commandFile: /path/to/bras2/addVRF }
+  run_once: true
+
+# Pipelined, paced to every router, and never more than 2000 lines per second overall
+- local_action:
+    module: cisco_exec_commands
+    username: admin
+    password: 123456
+    enable: 987654
+    pipeline: yes
+    adaptive: yes
+    window: 100
+    global_rate: 2000
+    hosts:
+      - { hostname: bras1, commandFile: /path/to/bras1/addVRF }
+      - { hostname: old1841, commandFile: /path/to/old1841/addVRF, rate: 20 }
+  run_once: true
+'''
+
+RETURN = '''
+commands:
+  description: Lines that were sent, or would be sent in check mode, when only_missing is used
+  returned: only_missing or check mode
+  type: list
+  sample: ["configure terminal", "interface Loopback100", "ip address 10.0.0.1 255.255.255.255", "exit", "end"]
+missing:
+  description: Lines of commandFile not found in the running-config
+  returned: check mode, or only_missing when nothing is sent
+  type: list
+  sample: ["ip address 10.0.0.1 255.255.255.255"]
+hosts:
+  description: Result of every router, keyed by hostname, with the wave it was in and its seconds
+  returned: hosts is used
+  type: dictionary
+  sample:
+    "hosts": {
+      "bras1": {"success": true, "changed": true, "msg": "", "wave": 1, "elapsed": 4.12},
+      "bras2": {"success": false, "msg": "Command error: \\"ip vrf forwarding RED\\"", "line": 12, "wave": 1, "elapsed": 3.9},
+      "bras3": {"success": false, "skipped": true, "msg": "Skipped after wave 1 failed", "wave": 2}
+    }
+summary:
+  description: Routers succeeded, failed and skipped, the wave that halted the deployment and the seconds per router
+  returned: hosts is used
+  type: dictionary
+  sample:
+    "summary": {
+      "hosts": 3, "succeeded": 1, "failed": 1, "skipped": 1, "changed": 1, "halted_after_wave": 1,
+      "latency": {"min": 3.9, "max": 4.12, "mean": 4.01, "p50": 4.12, "p95": 4.12}
+    }
 '''
 
 
+import os
+import re
 import sys
+import json
+import time
+import socket
 import string
+import tempfile
+import threading
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
+import paramiko
 from netlib.conn_type import SSH
 from ansible.module_utils.basic import *
 
 
-errmsg = ""
+class brokerError(Exception):
+  pass
+
+
+class brokerChannel(object):
+  """Paramiko channel look-alike that reads and writes the broker session"""
+  def __init__(self, session):
+    self.session = session
+    self.pending = ''
+
+  def sendall(self, data):
+    self.session.request(op='send', data=data)
+
+  def recv_ready(self):
+    if not self.pending:
+      self.pending = self.session.request(op='recv', timeout=0.05)['output']
+    return len(self.pending) > 0
+
+  def recv(self, size):
+    self.recv_ready()
+    data = self.pending[:size]
+    self.pending = self.pending[size:]
+    return data
+
+
+class brokerSSH(object):
+  """Session borrowed from cisco_broker, used like a netlib SSH object"""
+  def __init__(self, socketPath, hostname, username, password, enable):
+    self.socketPath = socketPath
+    self.hostname = hostname
+    self.username = username
+    self.password = password
+    self.enable = enable
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self.socketPath)
+    self.stream = self.sock.makefile('rw')
+    self.client_conn = brokerChannel(self)
+    self.request(op='open', hostname=self.hostname, username=self.username,
+                 password=self.password, enable=self.enable)
+
+  def request(self, **request):
+    self.stream.write(json.dumps(request) + '\n')
+    self.stream.flush()
+    reply = json.loads(self.stream.readline())
+    if 'error' in reply:
+      raise brokerError(reply['error'])
+    return reply
+
+  def set_enable(self, enable):
+    # Broker sessions are already enabled
+    pass
+
+  def command(self, command):
+    return self.request(op='command', command=command)['output']
+
+  def close(self):
+    self.stream.close()
+    self.sock.close()
+
+
+def openSession(hostname, username, password, enable, broker=None, timings=None):
+  start = time.time()
+  if broker and os.path.exists(broker):
+    session = brokerSSH(broker, hostname, username, password, enable)
+    try:
+      session.connect()
+      if timings is not None:
+        timings.phase('connect', time.time() - start)
+      return session
+    except (socket.error, ValueError):
+      # Stale socket or broker not answering, connect directly
+      pass
+
+  ssh = SSH(hostname, username, password)
+  ssh.connect()
+  connected = time.time()
+  ssh.set_enable(enable)
+  if timings is not None:
+    timings.phase('connect', connected - start)
+    timings.phase('enable', time.time() - connected)
+  return ssh
+
+
+MARKER = "!cisco_exec_commands"
+
+class runState(threading.local):
+  """Error and timings of the router being configured by the current thread"""
+  errmsg = ""
+  errline = 0
+  timings = None
+  pacer = None
+
+state = runState()
+
+
+class tokenBucket(object):
+  """rate tokens per second, at most burst of them saved while idle.
+
+  take() reserves the tokens at once and sleeps outside the lock, threads
+  sharing a bucket queue behind the reservations already made."""
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.burst = float(burst or max(1, rate))
+    self.tokens = self.burst
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  def take(self, count=1):
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      self.tokens -= count
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+
+class commandPacer(object):
+  """Lines sent to one router: rate limits and, with adaptive, the window.
+
+  The round trip is measured once with an empty line. Windows start at 4
+  lines, so the best seconds per line are those of a router keeping up. A
+  window grows by a quarter after every window answered at less than twice
+  the best seconds per line, and is halved otherwise: the router queues what
+  it cannot parse yet."""
+  def __init__(self, window, rate=0, globalBucket=None, adaptive=False):
+    self.bucket = tokenBucket(rate) if rate else None
+    self.globalBucket = globalBucket
+    self.maximum = max(1, window)
+    # A window goes in one send, more lines than a burst would beat the rate
+    for bucket in (self.bucket, globalBucket):
+      if bucket is not None:
+        self.maximum = min(self.maximum, max(1, int(bucket.burst)))
+    self.adaptive = adaptive
+    self.window = min(self.maximum, 4) if adaptive else self.maximum
+    self.roundTrip = None
+    self.best = None
+    self.waited = 0.0
+    self.windows = []
+
+  def calibrate(self, ssh, timeout):
+    channel = ssh.client_conn
+    start = time.time()
+    channel.sendall("\n")
+    readUntil(channel, PROMPT_END, timeout)
+    self.roundTrip = time.time() - start
+
+  def before(self, lines):
+    # Waits for the tokens of lines in both buckets
+    for bucket in (self.bucket, self.globalBucket):
+      if bucket is not None:
+        self.waited += bucket.take(lines)
+
+  def after(self, lines, seconds):
+    self.windows.append(lines)
+    if not self.adaptive:
+      return
+    perLine = max(0.0, seconds - (self.roundTrip or 0)) / lines
+    if self.best is None or perLine < self.best:
+      self.best = perLine
+    # A few milliseconds per line are noise, not a router falling behind
+    if perLine > 2 * self.best + 0.002:
+      self.window = max(1, self.window // 2)
+    else:
+      self.window = min(self.maximum, self.window + max(1, self.window // 4))
+
+  def report(self):
+    report = dict(waited=round(self.waited, 4))
+    if self.windows:
+      report.update(windows=len(self.windows), minWindow=min(self.windows),
+                    maxWindow=max(self.windows), lastWindow=self.window)
+    if self.roundTrip is not None:
+      report['roundTrip'] = round(self.roundTrip, 4)
+    if self.best is not None:
+      report['secondsPerLine'] = round(self.best, 5)
+    return report
+
+
+class commandTimings(object):
+  """Connection phases and round trip of every line, or window of lines"""
+  def __init__(self):
+    self.phases = {}
+    self.commands = []
+
+  def phase(self, name, seconds):
+    self.phases[name] = self.phases.get(name, 0) + seconds
+
+  def command(self, line, lines, command, seconds, size):
+    self.commands.append(dict(line=line, lines=lines, command=command.strip(),
+                              seconds=round(seconds, 4), bytes=size))
+
+  def report(self, slowest=None):
+    commands = self.commands
+    if slowest is not None:
+      commands = sorted(commands, key=lambda entry: entry['seconds'], reverse=True)[:slowest]
+    return dict(phases=dict((name, round(seconds, 4)) for name, seconds in self.phases.items()),
+                roundTrips=len(self.commands),
+                bytes=sum(entry['bytes'] for entry in self.commands),
+                commands=commands)
+
+
+def toText( data ):
+  if isinstance(data, bytes) and not isinstance(data, str):
+    return data.decode('utf-8', 'ignore')
+  return data
+
+
+class captureBuffer(object):
+  """Router output kept in a preallocated bytearray.
+
+  The buffer doubles up to limit bytes. Past it, all but the last keep bytes
+  are moved to a temporary file, so memory stays bounded whatever the size
+  of the output. Offsets count from the start of the capture."""
+  def __init__(self, size=65536, limit=1048576, keep=131072):
+    self.buffer = bytearray(size)
+    self.used = 0
+    self.spilled = 0
+    self.limit = limit
+    self.keep = keep
+    self.spill = None
+
+  def __len__(self):
+    return self.spilled + self.used
+
+  def write(self, data):
+    if not isinstance(data, (bytes, bytearray)):
+      data = data.encode('utf-8')
+    if self.used + len(data) > self.limit:
+      self.spillOld()
+    needed = self.used + len(data)
+    if needed > len(self.buffer):
+      size = len(self.buffer)
+      while size < needed:
+        size *= 2
+      self.buffer.extend(bytearray(size - len(self.buffer)))
+    self.buffer[self.used:needed] = data
+    self.used = needed
+
+  def spillOld(self):
+    start = self.used - self.keep
+    if start <= 0:
+      return
+    if self.spill is None:
+      self.spill = tempfile.TemporaryFile()
+    view = memoryview(self.buffer)
+    self.spill.write(view[:start])
+    view[:self.keep] = view[start:self.used].tobytes()
+    self.spilled += start
+    self.used = self.keep
+
+  def text(self, start=0):
+    # Text from offset start, only what is still in memory
+    start = max(0, start - self.spilled)
+    return toText(memoryview(self.buffer)[start:self.used].tobytes())
+
+  def getvalue(self):
+    if self.spill is None:
+      return self.text()
+    self.spill.seek(0)
+    return toText(self.spill.read() + memoryview(self.buffer)[:self.used].tobytes())
+
+  def lines(self):
+    # Every line of the capture, the spilled ones read back from the file
+    pending = b''
+    if self.spill is not None:
+      self.spill.seek(0)
+      for line in self.spill:
+        if not line.endswith(b'\n'):
+          pending = line
+          break
+        yield toText(line[:-1])
+    for line in toText(pending + memoryview(self.buffer)[:self.used].tobytes()).split("\n"):
+      yield line
+
+  def close(self):
+    if self.spill is not None:
+      self.spill.close()
+      self.spill = None
+
+
+def readUntil( channel, pattern, timeout, capture=None ):
+  # Read until pattern matches the output. The output is appended to
+  # capture, or returned as text without one.
+  own = capture is None
+  if own:
+    capture = captureBuffer()
+  scanned = len(capture)
+  first = scanned
+  deadline = time.time() + timeout
+  try:
+    while True:
+      if channel.recv_ready():
+        capture.write(channel.recv(65535))
+        # Only the new text can complete a match, keep a margin for split
+        # prompts and one character more so ^ does not match inside a line
+        start = max(first, scanned - 257)
+        if pattern.search(capture.text(start), 1 if start > first else 0):
+          return capture.getvalue() if own else capture
+        scanned = len(capture)
+      elif time.time() > deadline:
+        raise IOError("Timeout waiting for router output")
+      else:
+        time.sleep(0.01)
+  finally:
+    if own:
+      capture.close()
+
 
 def executeCommand( ssh, command ):
-  global errmsg
   prevLine = ""
-  returnValue = string.split(ssh.command(command),'\n')
+  start = time.time()
+  output = ssh.command(command)
+  if state.timings is not None:
+    state.timings.command(state.errline, 1, command, time.time() - start, len(output))
+  returnValue = string.split(output,'\n')
   for singleLine in returnValue:
     if singleLine[:2] == "% ":
       return False
-    errmsg = prevLine
+    state.errmsg = prevLine
     prevLine = singleLine
 
   return True
 
 
-def executeCommandList( ssh, commandFile ):
-  with open(commandFile) as f:
-    commandList = f.readlines()
+WINDOW_MARKER = re.compile(re.escape(MARKER) + r" (\d+)\r?$")
 
-  for command in commandList:
-    if not executeCommand(ssh,command):
-      return False
+
+def executeWindow( ssh, commandList, first, timeout ):
+  # Every line is followed by a numbered comment, its echo delimits the
+  # output of the line that precedes it.
+  payload = ""
+  for number in range(first, first + len(commandList)):
+    payload += commandList[number - first].rstrip('\r\n') + "\n"
+    payload += "%s %d\n" % (MARKER, number)
+
+  last = first + len(commandList) - 1
+  pattern = re.compile(re.escape("%s %d" % (MARKER, last)) + r"\r?\n[^\n]*[>#]")
+  start = time.time()
+  capture = captureBuffer()
+  try:
+    ssh.client_conn.sendall(payload)
+    readUntil(ssh.client_conn, pattern, timeout, capture)
+    if state.timings is not None:
+      state.timings.command(first + 1, len(commandList), commandList[0], time.time() - start, len(capture))
+
+    # Scanned line by line, a long window may be in the spill file
+    failed = False
+    for singleLine in capture.lines():
+      if singleLine[:2] == "% ":
+        failed = True
+        continue
+      marker = WINDOW_MARKER.search(singleLine)
+      if marker is not None and failed:
+        number = int(marker.group(1))
+        state.errline = number + 1
+        state.errmsg = commandList[number - first].rstrip('\r\n')
+        return False
+  finally:
+    capture.close()
 
   return True
 
 
+def executeCommandList( ssh, commandFile, window=0, timeout=60, commandList=None, lineNumbers=None ):
+  # commandList replaces the lines of commandFile, lineNumbers are their
+  # numbers in commandFile for the error report
+  if commandList is None:
+    with open(commandFile) as f:
+      commandList = f.readlines()
+
+  pacer = state.pacer
+  success = True
+  if window:
+    while ssh.client_conn.recv_ready():
+      ssh.client_conn.recv(65535)
+    if pacer is not None and pacer.adaptive and pacer.roundTrip is None:
+      pacer.calibrate(ssh, timeout)
+    first = 0
+    while first < len(commandList):
+      size = pacer.window if pacer is not None else window
+      lines = commandList[first:first + size]
+      if pacer is not None:
+        pacer.before(len(lines))
+      start = time.time()
+      if not executeWindow(ssh, lines, first, timeout):
+        success = False
+        break
+      if pacer is not None:
+        pacer.after(len(lines), time.time() - start)
+      first += size
+  else:
+    for number, command in enumerate(commandList):
+      state.errline = number + 1
+      if pacer is not None:
+        pacer.before(1)
+      if not executeCommand(ssh,command):
+        success = False
+        break
+
+  if not success and lineNumbers is not None:
+    state.errline = lineNumbers[state.errline - 1]
+  return success
+
+
+# Lines of the command file that only make sense typed at the CLI
+SESSION_LINES = ("enable", "configure terminal", "conf t", "end")
+CONFIG_ERRORS = ("% Invalid", "% Incomplete", "% Ambiguous", "%Invalid", "%Error", "% Rollback aborted")
+QUESTION = re.compile(r"(?:\?|\[confirm\]|\[yes/no\]:?)\s*$")
+STEP_END = re.compile(r"(?:[>#?\]:])\s*$")
+PROMPT_END = re.compile(r"(?:^|\n)[\w.\-/]+(?:\([\w.\-/ ]+\))?[>#]\s*$")
+
+REMOTE_COMMANDS = "ansible_commands.cfg"
+REMOTE_CHECKPOINT = "ansible_checkpoint.cfg"
+
+
+def configurationText( commandList ):
+  # The lines as the router reads them with copy or configure replace
+  lines = []
+  for line in commandList:
+    if line.strip() not in SESSION_LINES:
+      lines.append(line.rstrip('\r\n'))
+  lines.append("end")
+  return '\n'.join(lines) + '\n'
+
+
+def scpAck( channel ):
+  answer = channel.recv(1)
+  if answer != b'\0':
+    raise IOError("SCP upload refused: " + toText(answer + channel.recv(1024)).strip())
+
+
+def scpUpload( hostname, username, password, data, remotePath, timeout ):
+  # One file transfer instead of a round trip per line. The router needs
+  # "ip scp server enable" and a privilege 15 user.
+  client = paramiko.SSHClient()
+  client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+  client.connect(hostname, username=username, password=password, timeout=timeout,
+                 look_for_keys=False, allow_agent=False)
+  try:
+    channel = client.get_transport().open_session()
+    channel.settimeout(timeout)
+    channel.exec_command("scp -t " + remotePath)
+    data = data.encode('utf-8')
+    channel.sendall(("C0644 %d %s\n" % (len(data), os.path.basename(remotePath.split(':')[-1]))).encode('utf-8'))
+    scpAck(channel)
+    channel.sendall(data)
+    channel.sendall(b'\0')
+    scpAck(channel)
+    channel.close()
+  finally:
+    client.close()
+
+
+def interactiveCommand( ssh, command, timeout ):
+  # Answer the questions of copy and delete with their default until the prompt
+  channel = ssh.client_conn
+  while channel.recv_ready():
+    channel.recv(65535)
+  channel.sendall(command + "\n")
+  output = ''
+  answered = 0
+  while True:
+    output += readUntil(channel, STEP_END, timeout)
+    if PROMPT_END.search(output):
+      return output
+    # Only a question asked after the last answer, not its echo
+    if QUESTION.search(output) and output[answered:].strip():
+      channel.sendall("\n")
+      answered = len(output)
+
+
+def configurationErrors( output ):
+  # (line, error) of every error, line is the one echoed before the error
+  errors = []
+  previous = None
+  for line in string.split(output, '\n'):
+    line = line.strip()
+    if line.startswith(CONFIG_ERRORS):
+      errors.append((previous, line))
+    elif line and not line.startswith('^'):
+      previous = line
+  return errors
+
+
+def failedLine( commandFile, command ):
+  with open(commandFile) as f:
+    for number, line in enumerate(f):
+      if command is not None and line.strip() == command:
+        return number + 1
+  return None
+
+
+def executeTransaction( ssh, hostname, username, password, commandFile, mode, remoteDir, timeout,
+                        commandList=None ):
+  """Upload commandFile and apply it at once, restoring the running-config
+  saved before when the router reports an error. Returns (success, rolledBack)"""
+  state.errline = None
+  remoteCommands = remoteDir + REMOTE_COMMANDS
+  remoteCheckpoint = remoteDir + REMOTE_CHECKPOINT
+
+  if commandList is None:
+    with open(commandFile) as f:
+      commandList = f.readlines()
+
+  start = time.time()
+  scpUpload(hostname, username, password, configurationText(commandList), remoteCommands, timeout)
+  if state.timings is not None:
+    state.timings.phase('upload', time.time() - start)
+
+  ssh.command("terminal length 0")
+  output = interactiveCommand(ssh, "copy running-config " + remoteCheckpoint, timeout)
+  errors = configurationErrors(output)
+  if errors:
+    state.errmsg = "Checkpoint failed, nothing applied: " + errors[0][1]
+    return False, False
+
+  start = time.time()
+  if mode == 'replace':
+    output = interactiveCommand(ssh, "configure replace %s force" % remoteCommands, timeout)
+  else:
+    output = interactiveCommand(ssh, "copy %s running-config" % remoteCommands, timeout)
+  errors = configurationErrors(output)
+  if state.timings is not None:
+    state.timings.phase('apply', time.time() - start)
+
+  rolledBack = False
+  if errors:
+    command, error = errors[0]
+    state.errline = failedLine(commandFile, command)
+    state.errmsg = command if state.errline else error
+    start = time.time()
+    output = interactiveCommand(ssh, "configure replace %s force" % remoteCheckpoint, timeout)
+    if state.timings is not None:
+      state.timings.phase('rollback', time.time() - start)
+    if configurationErrors(output) or "Rollback Done" not in output:
+      # The checkpoint is left on the router to restore it by hand
+      state.errmsg += " (rollback to %s failed)" % remoteCheckpoint
+      return False, False
+    rolledBack = True
+
+  interactiveCommand(ssh, "delete /force " + remoteCommands, timeout)
+  interactiveCommand(ssh, "delete /force " + remoteCheckpoint, timeout)
+  return not errors, rolledBack
+
+
+# Commands that enter a section of the configuration, and those that enter
+# a section inside the current one
+SECTION_COMMANDS = ("interface ", "ip vrf ", "vrf definition ", "router ", "line ", "class-map ",
+                    "policy-map ", "route-map ", "ip access-list ", "controller ")
+SUBSECTION_COMMANDS = ("address-family ", "class ")
+INTERFACE_COMMANDS = ("ip vrf forwarding ", "ip vrf receive ", "ip vrf sitemap ")
+INTERFACE_TYPES = ("gigabitethernet", "fastethernet", "tengigabitethernet", "ethernet", "loopback",
+                   "port-channel", "vlan", "tunnel", "serial", "dialer", "virtual-template",
+                   "multilink", "bvi")
+RUNNING_CONFIG_END = re.compile(r"\nend\r?\n[\w.\-/]+[>#]\s*$")
+
+
+def canonicalLine( line ):
+  # gigabitEthernet 0/0.100 and GigabitEthernet0/0.100 are the same interface
+  words = line.split()
+  if len(words) > 1 and words[0] == "interface":
+    name = "".join(words[1:]).lower()
+    kind = re.match(r"[a-z\-]*", name).group(0)
+    for fullKind in INTERFACE_TYPES:
+      if kind and fullKind.startswith(kind):
+        name = fullKind + name[len(kind):]
+        break
+    return "interface " + name
+  return " ".join(words)
+
+
+def runningConfigTree( runningConfig ):
+  # Lines of every section keyed by the path of section lines above them,
+  # the top level lines are in the () section
+  tree = {}
+  stack = []
+  for line in string.split(runningConfig, '\n'):
+    line = line.rstrip('\r')
+    if not line.strip() or line.startswith('!') or line.strip() == "end":
+      continue
+    indent = len(line) - len(line.lstrip())
+    while stack and stack[-1][0] >= indent:
+      stack.pop()
+    canonical = canonicalLine(line)
+    tree.setdefault(tuple(entry[1] for entry in stack), set()).add(canonical)
+    stack.append((indent, canonical))
+  return tree
+
+
+def commandEntries( commandList ):
+  # Section path of every line of the command file, indented or not,
+  # following the modes the CLI would go through
+  entries = []
+  path = ()
+  headers = ()
+  for number, line in enumerate(commandList):
+    command = line.strip()
+    if not command or command.startswith('!'):
+      continue
+    entry = dict(number=number + 1, line=line.rstrip('\r\n'), canonical=canonicalLine(command),
+                 path=path, header=False, session=False)
+    if command in SESSION_LINES or command == "exit" or command == "exit-address-family":
+      entry['session'] = True
+      if command == "end":
+        path, headers = (), ()
+      elif command == "exit" and path:
+        path, headers = path[:-1], headers[:-1]
+      elif command == "exit-address-family" and len(path) > 1:
+        path, headers = path[:1], headers[:1]
+    elif command.startswith(SECTION_COMMANDS) and not command.startswith(INTERFACE_COMMANDS):
+      entry['path'] = ()
+      entry['header'] = True
+      path, headers = (entry['canonical'],), (entry['line'].strip(),)
+    elif command.startswith(SUBSECTION_COMMANDS) and path:
+      entry['path'] = path[:1]
+      entry['header'] = True
+      path, headers = path[:1] + (entry['canonical'],), headers[:1] + (entry['line'].strip(),)
+    entry['headers'] = headers
+    entries.append(entry)
+  return entries
+
+
+def isPresent( entry, position, sectionEntries, tree ):
+  # position is the index of entry in sectionEntries, the entries of its
+  # section in the order of the file
+  section = tree.get(entry['path'], set())
+  command = entry['canonical']
+  if command in section:
+    return True
+  if command.startswith("no "):
+    # "no X" resets X before the file sets it again, or "no shutdown" is the default
+    setting = command[3:]
+    for index in range(position + 1, len(sectionEntries)):
+      later = sectionEntries[index]
+      if later['canonical'].startswith(setting):
+        return later['canonical'] in section
+    if setting == "shutdown":
+      return "shutdown" not in section
+  return False
+
+
+def missingCommands( commandList, runningConfig ):
+  """Lines of commandList not in runningConfig, and the lines to send.
+
+  A section with a missing line is sent whole: the order of the lines of a
+  section matters (ip vrf forwarding removes the address set before it).
+  Returns (missing, [(line number, command)])"""
+  tree = runningConfigTree(runningConfig)
+  entries = [entry for entry in commandEntries(commandList)]
+  sections = {}
+  positions = []
+  for entry in entries:
+    section = sections.setdefault(entry['path'], [])
+    positions.append(len(section))
+    section.append(entry)
+  missing = [entry for entry, position in zip(entries, positions)
+             if not entry['session'] and not isPresent(entry, position, sections[entry['path']], tree)]
+  missingNumbers = set(entry['number'] for entry in missing)
+  dirty = set()
+  for entry in missing:
+    if entry['header']:
+      dirty.add(entry['path'] + (entry['canonical'],))
+    if entry['path']:
+      dirty.add(entry['path'])
+
+  commands = []
+  context = []
+  def navigate( path, headers, number ):
+    # Leave the sections not in path, then enter the ones missing
+    while len(context) > len(path) or tuple(context) != path[:len(context)]:
+      left = context.pop()
+      commands.append((number, "exit-address-family" if left.startswith("address-family ") else "exit"))
+    for index in range(len(context), len(path)):
+      context.append(path[index])
+      commands.append((number, headers[index]))
+
+  for entry in entries:
+    if entry['session']:
+      if entry['canonical'] in ("enable", "configure terminal", "conf t") and not context:
+        commands.append((entry['number'], entry['line']))
+      continue
+    if entry['header']:
+      section = entry['path'] + (entry['canonical'],)
+      if section in dirty:
+        navigate(section, entry['headers'], entry['number'])
+    elif entry['path'] in dirty or (not entry['path'] and entry['number'] in missingNumbers):
+      navigate(entry['path'], entry['headers'], entry['number'])
+      commands.append((entry['number'], entry['line']))
+
+  if len(commands) > len([entry for entry in entries if entry['session'] and not entry['path']
+                          and entry['canonical'] in ("enable", "configure terminal", "conf t")]):
+    navigate((), (), None)
+    commands.append((None, "end"))
+  else:
+    commands = []
+  return [entry['line'] for entry in missing], commands
+
+
+def fetchRunningConfig( ssh, hostname, cacheDir, timeout ):
+  # show running-config, or its copy in cacheDir while the router reports
+  # the same last configuration change
+  path = None
+  lastChange = None
+  if cacheDir:
+    path = os.path.join(cacheDir, hostname.replace(os.sep, '_') + '.json')
+    for line in string.split(ssh.command("show run | inc configuration change"), '\n'):
+      if line.startswith("! "):
+        lastChange = line.strip()
+    try:
+      with open(path) as f:
+        cached = json.load(f)
+      if lastChange and cached['lastChange'] == lastChange:
+        return cached['config']
+    except (IOError, ValueError, KeyError):
+      pass
+
+  channel = ssh.client_conn
+  while channel.recv_ready():
+    channel.recv(65535)
+  channel.sendall("show running-config\n")
+  # Read whole, every line of it goes into the tree and the cache anyway
+  runningConfig = readUntil(channel, RUNNING_CONFIG_END, timeout)
+
+  if path is not None and lastChange:
+    if not os.path.isdir(cacheDir):
+      os.makedirs(cacheDir)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(dict(lastChange=lastChange, config=runningConfig), f)
+    os.rename(path + '.tmp', path)
+  return runningConfig
+
+
+TRACE_LOCK = threading.Lock()
+
+
+def deployHost( host, checkMode=False, globalBucket=None ):
+  """Execute the commandFile of host, a dict with the module parameters, in
+  its router. Returns (success, result), result has the msg and line of the
+  error when success is False."""
+  hostname = host['hostname']
+  username = host['username']
+  password = host['password']
+  enable = host['enable']
+  commandFile = host['commandFile']
+  broker = host['broker']
+  pipeline = host['pipeline']
+  window = host['window']
+  timeout = host['timeout']
+  traceFile = host['trace_file']
+  transaction = host['transaction']
+  commandResult = False
+  msg = ""
+
+  if host['only_missing'] and transaction == 'replace':
+    # configure replace with the missing lines only would wipe the rest of the router
+    return False, dict(msg="only_missing cannot be used with transaction=replace")
+
+  state.errmsg = ""
+  state.errline = 0
+  state.timings = None
+  state.pacer = None
+  if host['timings'] or traceFile:
+    state.timings = commandTimings()
+  # Host dicts built by other callers may leave the rate limits out
+  rate = host.get('rate') or 0
+  adaptive = host.get('adaptive') or False
+  if rate or adaptive or globalBucket is not None:
+    state.pacer = commandPacer(window, rate, globalBucket, adaptive and pipeline)
+  start = time.time()
+
+  ssh = openSession(hostname, username, password, enable, broker, state.timings)
+  executed = time.time()
+
+  result = {}
+  connected = True
+  try:
+    commandList = None
+    lineNumbers = None
+    if host['only_missing'] or checkMode:
+      with open(commandFile) as f:
+        fileList = f.readlines()
+      ssh.command("terminal length 0")
+      fetched = time.time()
+      runningConfig = fetchRunningConfig(ssh, hostname, host['config_cache'], timeout)
+      if state.timings is not None:
+        state.timings.phase('running_config', time.time() - fetched)
+      missing, commands = missingCommands(fileList, runningConfig)
+      result['commands'] = [command for number, command in commands]
+      if checkMode or not commands:
+        return True, dict(changed=bool(commands), msg=msg, missing=missing, **result)
+      lineNumbers = [number for number, command in commands]
+      commandList = [command + '\n' for command in result['commands']]
+      if host['config_cache']:
+        # The copy is outdated as soon as a line is applied
+        cached = os.path.join(host['config_cache'], hostname.replace(os.sep, '_') + '.json')
+        if os.path.exists(cached):
+          os.unlink(cached)
+
+    if transaction:
+      try:
+        commandResult, result['rolled_back'] = executeTransaction(
+          ssh, hostname, username, password, commandFile, transaction,
+          host['remote_dir'], timeout, commandList)
+      except (IOError, socket.error, paramiko.SSHException) as e:
+        # Nothing left to end on a broken connection
+        connected = False
+        return False, dict(msg="Transaction failed: " + str(e), **result)
+    elif pipeline:
+      ssh.command("terminal length 0")
+      commandResult=executeCommandList(ssh, commandFile, max(1, window), timeout, commandList, lineNumbers)
+    else:
+      commandResult=executeCommandList(ssh, commandFile, commandList=commandList, lineNumbers=lineNumbers)
+  finally:
+    if connected:
+      try:
+        # Back to exec mode on every path, a broker lends the session again
+        ssh.command("end")
+      except Exception:
+        pass
+    ssh.close()
+
+  if state.timings is not None:
+    state.timings.phase('execute', time.time() - executed)
+    state.timings.phase('total', time.time() - start)
+    if traceFile:
+      record = dict(time=round(start, 3), hostname=hostname, commandFile=commandFile,
+                    success=commandResult, timings=state.timings.report())
+      if state.pacer is not None:
+        record['pacing'] = state.pacer.report()
+      with TRACE_LOCK:
+        with open(traceFile, 'a') as f:
+          f.write(json.dumps(record, sort_keys=True) + '\n')
+    if host['timings']:
+      # The whole list of round trips is only written to trace_file
+      result['timings'] = state.timings.report(slowest=10)
+      if state.pacer is not None:
+        result['timings']['pacing'] = state.pacer.report()
+
+  if not commandResult:
+    return False, dict(msg="Command error: \"" + state.errmsg + "\"", line=state.errline, **result)
+  return True, dict(changed=True, msg=msg, **result)
+
+
+def deployTimed( host, checkMode=False, globalBucket=None ):
+  # Errors of a router are its result, they do not stop the other routers
+  start = time.time()
+  try:
+    success, result = deployHost(host, checkMode, globalBucket)
+  except Exception as e:
+    success, result = False, dict(msg=str(e))
+  return success, result, time.time() - start
+
+
+def latencySummary( values ):
+  if not values:
+    return {}
+  values = sorted(values)
+  def percentile( fraction ):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+  return dict(min=round(values[0], 3), max=round(values[-1], 3),
+              mean=round(sum(values) / len(values), 3),
+              p50=round(percentile(0.5), 3), p95=round(percentile(0.95), 3))
+
+
+def rollingDeploy( hosts, concurrency=20, waveSize=0, maxFailPercentage=0, checkMode=False,
+                   globalRate=0 ):
+  """Deploy hosts in waves of waveSize routers, at most concurrency at the
+  same time and globalRate lines per second between all of them. When more
+  than maxFailPercentage of the routers of a wave fail, the next waves are
+  skipped. Returns (results by hostname, summary)"""
+  waveSize = waveSize or len(hosts)
+  globalBucket = tokenBucket(globalRate) if globalRate else None
+  results = {}
+  halted = None
+  pool = ThreadPool(max(1, min(concurrency, waveSize)))
+  try:
+    for wave, first in enumerate(range(0, len(hosts), waveSize)):
+      waveHosts = hosts[first:first + waveSize]
+      if halted is not None:
+        for host in waveHosts:
+          results[host['hostname']] = dict(success=False, skipped=True, wave=wave + 1,
+                                           msg="Skipped after wave %d failed" % halted)
+        continue
+      outcomes = pool.map(partial(deployTimed, checkMode=checkMode, globalBucket=globalBucket),
+                          waveHosts)
+      failed = 0
+      for host, (success, result, elapsed) in zip(waveHosts, outcomes):
+        result.update(success=success, elapsed=round(elapsed, 3), wave=wave + 1)
+        results[host['hostname']] = result
+        if not success:
+          failed += 1
+      if failed * 100.0 / len(waveHosts) > maxFailPercentage:
+        halted = wave + 1
+  finally:
+    pool.close()
+    pool.join()
+
+  attempted = [result for result in results.values() if not result.get('skipped')]
+  summary = dict(hosts=len(hosts),
+                 succeeded=len([result for result in attempted if result['success']]),
+                 failed=len([result for result in attempted if not result['success']]),
+                 skipped=len(results) - len(attempted),
+                 changed=len([result for result in attempted if result.get('changed')]),
+                 halted_after_wave=halted,
+                 latency=latencySummary([result['elapsed'] for result in attempted]))
+  return results, summary
+
+
+BOOLEAN_TRUE = ('yes', 'on', 'true', '1', 'y', 't')
+BOOLEAN_FALSE = ('no', 'off', 'false', '0', 'n', 'f')
+
+
+def hostEntry( entry, defaults, argumentSpec ):
+  """The module parameters of one item of hosts, defaults overridden by the
+  item with its values converted like the module arguments. Raises
+  ValueError for an unknown option or a wrong value."""
+  host = dict(defaults)
+  for key, value in entry.items():
+    if key not in defaults:
+      raise ValueError("Unknown option %s in hosts" % key)
+    spec = argumentSpec[key]
+    kind = spec.get('type', 'str')
+    if value is None:
+      pass
+    elif kind == 'bool' and not isinstance(value, bool):
+      if str(value).lower() in BOOLEAN_TRUE:
+        value = True
+      elif str(value).lower() in BOOLEAN_FALSE:
+        value = False
+      else:
+        raise ValueError("%s of %s is not a boolean: %s" % (key, entry.get('hostname'), value))
+    elif kind in ('int', 'float'):
+      try:
+        # "50" is an int, 2.5 and "2.5" are not
+        value = int(str(value)) if kind == 'int' else float(value)
+      except (TypeError, ValueError):
+        raise ValueError("%s of %s is not %s %s: %s" % (key, entry.get('hostname'),
+                         'an' if kind == 'int' else 'a', kind, value))
+    if value is not None and 'choices' in spec and value not in spec['choices']:
+      raise ValueError("%s of %s has to be one of %s: %s" % (key, entry.get('hostname'),
+                       ", ".join(spec['choices']), value))
+    host[key] = value
+  return host
+
+
 def main():
 
   module = AnsibleModule(
     argument_spec=dict(
-      hostname=dict(required=True),
+      hostname=dict(required=False),
       username=dict(required=True),
       password=dict(required=True),
       enable=dict(required=True),
-      commandFile=dict(required=True)
-      )
+      commandFile=dict(required=False),
+      broker=dict(required=False, default='/tmp/cisco_broker.sock'),
+      pipeline=dict(required=False, type='bool', default=False),
+      window=dict(required=False, type='int', default=50),
+      timeout=dict(required=False, type='int', default=60),
+      timings=dict(required=False, type='bool', default=False),
+      trace_file=dict(required=False),
+      transaction=dict(required=False, choices=['merge', 'replace']),
+      remote_dir=dict(required=False, default='flash:'),
+      only_missing=dict(required=False, type='bool', default=False),
+      config_cache=dict(required=False),
+      hosts=dict(required=False, type='list'),
+      concurrency=dict(required=False, type='int', default=20),
+      wave_size=dict(required=False, type='int', default=0),
+      max_fail_percentage=dict(required=False, type='int', default=0),
+      rate=dict(required=False, type='float', default=0),
+      global_rate=dict(required=False, type='float', default=0),
+      adaptive=dict(required=False, type='bool', default=False)
+      ),
+    required_one_of=[['hostname', 'hosts']],
+    mutually_exclusive=[['hostname', 'hosts']],
+    supports_check_mode=True
   )
 
+  hosts = module.params['hosts']
+  defaults = dict(module.params)
+  for key in ('hosts', 'concurrency', 'wave_size', 'max_fail_percentage', 'global_rate'):
+    del defaults[key]
 
-  hostname = module.params['hostname']
-  username = module.params['username']
-  password = module.params['password']
-  enable = module.params['enable']
-  commandFile = module.params['commandFile']
-  changed = False
-  commandResult = False
-  msg = ""
-
-  ssh = SSH(hostname, username, password)
-  ssh.connect()
-  ssh.set_enable(enable)
-
-  commandResult=executeCommandList(ssh, commandFile)
+  if hosts is not None:
+    # Every item overrides the module parameters for its router
+    deployments = []
+    for entry in hosts:
+      if not isinstance(entry, dict) or 'hostname' not in entry or 'commandFile' not in entry:
+        module.fail_json(msg="Every item of hosts needs a hostname and a commandFile")
+      try:
+        deployments.append(hostEntry(entry, defaults, module.argument_spec))
+      except ValueError as e:
+        module.fail_json(msg=str(e))
+    if len(set(host['hostname'] for host in deployments)) < len(deployments):
+      module.fail_json(msg="A hostname appears more than once in hosts")
+    for host in deployments:
+      if host['only_missing'] and host['transaction'] == 'replace':
+        module.fail_json(msg="only_missing cannot be used with transaction=replace (%s)" % host['hostname'])
 
-  ssh.command("end")
-  ssh.close()
+    results, summary = rollingDeploy(deployments, module.params['concurrency'],
+                                     module.params['wave_size'],
+                                     module.params['max_fail_percentage'], module.check_mode,
+                                     module.params['global_rate'])
+    if summary['failed'] or summary['skipped']:
+      module.fail_json(msg="Deployment failed on %d of %d routers" % (summary['failed'], summary['hosts']),
+                       hosts=results, summary=summary)
+    module.exit_json(changed=summary['changed'] > 0, hosts=results, summary=summary)
 
+  if module.params['commandFile'] is None:
+    module.fail_json(msg="commandFile is required with hostname")
+  if module.params['only_missing'] and module.params['transaction'] == 'replace':
+    module.fail_json(msg="only_missing cannot be used with transaction=replace")
 
-  if not commandResult:
-     module.fail_json(msg="Command error: \"" + errmsg + "\"")
+  globalBucket = None
+  if module.params['global_rate']:
+    globalBucket = tokenBucket(module.params['global_rate'])
+  success, result = deployHost(defaults, module.check_mode, globalBucket)
+  if not success:
+     module.fail_json(**result)
   else:
-    changed = True
-    module.exit_json(changed=changed, msg=msg, username=username, password=password, enable=enable)
+    module.exit_json(username=defaults['username'], password=defaults['password'],
+                     enable=defaults['enable'], **result)
 
 
-main()
+if __name__ == '__main__':
+  main()
@@ -20,29 +20,226 @@ module: cisco_gather_facts
 short_description: Get facts of a Cisco IOS router
 description:
     - Get facts of a Cisco IOS router
+    - With hostnames, get facts of several routers concurrently. Facts are
+      returned in cisco_hosts keyed by hostname and the routers that could
+      not be gathered are reported in errors.
 author: Antonio Arriaga Diaz
 version_added: 1.0
 options:
   hostname:
     description:
-      - Hostame or IP address of router.
-    required: true
+      - Hostame or IP address of router. Required unless hostnames is used.
+    required: false
+  hostnames:
+    description:
+      - List of hostnames or IP addresses of routers to gather in batch mode.
+    required: false
+  workers:
+    description:
+      - Maximum number of routers gathered at the same time in batch mode.
+        With capture_dir, routers are parsed by processes, at most one per CPU.
+    required: false
+    default: 20
+  gather_subset:
+    description:
+      - Restrict the facts gathered to a subset. Possible values are all,
+        bgp, vrf, interfaces, version and hostname. A value prefixed with !
+        excludes that subset, when only exclusions are given every other
+        subset is gathered. !all gathers only the subsets listed with it.
+    required: false
+    default: all
+  interfaces_mode:
+    description:
+      - How the interfaces subset is gathered. full parses show interfaces.
+        brief builds the interfaces from show ip interface brief and show
+        interfaces description, with name, status, IP and description only.
+    required: false
+    default: full
+    choices: [ "full", "brief" ]
+  interfaces_detail:
+    description:
+      - Regular expression matching whole interface names. In brief mode,
+        show interfaces is run for the matching interfaces to add mtu, mac,
+        mask, encapsulation and vlanid to them.
+    required: false
+  cache_dir:
+    description:
+      - Directory where the facts of every router are cached. Cached facts
+        younger than cache_ttl are returned without connecting to the router.
+    required: false
+  cache_ttl:
+    description:
+      - Seconds cached facts are returned without checking the router.
+    required: false
+    default: 3600
+  cache_probe:
+    description:
+      - When cached facts are older than cache_ttl, compare the last
+        configuration change of the running-config with the cached one and
+        keep using the cached vrf and hostname facts when it has not
+        changed. bgp, interfaces and version change without a configuration
+        change and are gathered again.
+    required: false
+    default: true
+  snapshot_dir:
+    description:
+      - Directory where the last facts of every router are kept. The
+        differences with the previous facts are returned in cisco_delta.
+    required: false
+  index:
+    description:
+      - Add cisco.index with lookup tables of the gathered facts. rd maps
+        every RD to the name of its local VRF (null when the RD is only known
+        by BGP), vrf maps every VRF name to its RD (null when it has none)
+        and ip maps every IP address to the interfaces that have it.
+    required: false
+    default: true
+  burst:
+    description:
+      - Send all show commands at once and split their output afterwards,
+        instead of waiting for the prompt of every command.
+    required: false
+    default: false
+  timeout:
+    description:
+      - Seconds to wait for the output of all show commands when burst is used.
+    required: false
+    default: 120
   username:
     description:
-      - Username used to login to the router
-    required: true
+      - Username used to login to the router. Required unless capture_dir is used.
+    required: false
   password:
     description:
-      - Password used to login to the router
-    required: true
+      - Password used to login to the router. Required unless capture_dir is used.
+    required: false
   enable:
     description:
-      - Enable password used to enable to the router
-    required: true
+      - Enable password used to enable to the router. Required unless capture_dir is used.
+    required: false
+  broker:
+    description:
+      - Unix socket of a running cisco_broker. When the socket exists the
+        session is borrowed from the broker instead of opening a new SSH
+        connection.
+    required: false
+    default: "/tmp/cisco_broker.sock"
+  timings:
+    description:
+      - Return in timings where the time of every router went: connection,
+        enable, every show command with its bytes, and every parser.
+    required: false
+    default: false
+  trace_file:
+    description:
+      - Append the timings of every router to this file, one JSON object
+        per line, to compare routers and runs afterwards.
+    required: false
+  capture_dir:
+    description:
+      - Build the facts from saved show outputs instead of connecting to the
+        routers. The outputs of a router are either one file per command in
+        capture_dir/<hostname>/, named after the command with underscores
+        (show_ip_bgp_summary, optionally with .txt), or a session log
+        capture_dir/<hostname>.log where every command follows the prompt.
+        Without hostname and hostnames, every router of capture_dir is
+        parsed. cache_dir is ignored.
+    required: false
+  parse_workers:
+    description:
+      - Number of processes parsing the show outputs. When set, outputs are
+        collected first and then parsed in the pool, show interfaces in
+        chunks of 250 interfaces, so the parsing of routers gathered at once
+        is spread between CPUs. 0 parses in the gathering thread, while the
+        output is read. Ignored with capture_dir.
+    required: false
+    default: 0
+  parser:
+    description:
+      - legacy parses the show outputs at fixed columns. regex matches every
+        line once against compiled regex tables, which also copes with long
+        VRF names and shifted columns. Both return the same facts for
+        regular outputs.
+    required: false
+    default: legacy
+    choices: ["legacy", "regex"]
+  export_db:
+    description:
+      - SQLite database where the facts of every run are appended, in the
+        tables interfaces, vrfs, vrf_interfaces, neighbors and rds, each
+        with the run and the hostname of its rows. The current_<table> views
+        hold the rows of the last run that gathered them for every router.
+        Created when it does not exist.
+    required: false
+  rd_index:
+    description:
+      - SQLite index of the RDs and VRF names of the fleet, updated with the
+        bgp and vrf facts of every router gathered. cisco_rd_index checks
+        and allocates RDs with it without connecting to any router.
+    required: false
 '''
 
 EXAMPLES = '''
 - cisco_gather_facts: hostname=10.1.1.100 username=admin password=123456 enable=987654
+
+# Only BGP and VRF facts, skipping the slow show interfaces
+- cisco_gather_facts: hostname=10.1.1.100 username=admin password=123456 enable=987654 gather_subset=bgp,vrf
+
+# Brief interfaces, with the full detail of the loopbacks only
+- cisco_gather_facts: hostname=10.1.1.100 username=admin password=123456 enable=987654 interfaces_mode=brief interfaces_detail=Loopback.*
+
+# Reuse facts gathered less than 10 minutes ago
+- cisco_gather_facts: hostname=10.1.1.100 username=admin password=123456 enable=987654 cache_dir=/var/cache/cisco cache_ttl=600
+
+# Check a RD with a single condition
+- fail: msg="RD 65010:103 already exists"
+  when: "'65010:103' in cisco.index.rd"
+
+# Only react to what changed since the previous run
+- cisco_gather_facts: hostname=10.1.1.100 username=admin password=123456 enable=987654 snapshot_dir=/var/lib/cisco/snapshots
+- debug: msg="New VRF {{ item }}"
+  with_items: cisco_delta.vrf.added
+
+# Everything but the interfaces
+- cisco_gather_facts: hostname=10.1.1.100 username=admin password=123456 enable=987654 gather_subset=!interfaces
+
+# Gather all BRAS routers in a single task
+- local_action:
+    module: cisco_gather_facts
+    hostnames: "{{ groups['bras'] }}"
+    workers: 50
+    username: admin
+    password: 123456
+    enable: 987654
+  run_once: true
+
+# Aggregation routers with thousands of interfaces, parsed on 8 CPUs
+- local_action:
+    module: cisco_gather_facts
+    hostnames: "{{ groups['aggregation'] }}"
+    parse_workers: 8
+    username: admin
+    password: 123456
+    enable: 987654
+  run_once: true
+
+# Rebuild the facts of every router from last night's outputs
+- local_action: cisco_gather_facts capture_dir=/var/lib/collector/latest
+  run_once: true
+
+# Fleet-wide inventory, queried afterwards with
+#   SELECT hostname FROM current_rds WHERE rd = '65010:103'
+- local_action:
+    module: cisco_gather_facts
+    hostnames: "{{ groups['bras'] }}"
+    export_db: /var/lib/cisco/facts.db
+    username: admin
+    password: 123456
+    enable: 987654
+  run_once: true
+
+# Find the slow routers of the fleet
+- cisco_gather_facts: hostname=10.1.1.100 username=admin password=123456 enable=987654 trace_file=/var/log/cisco_timings.jsonl
 '''
 
 
@@ -265,57 +462,884 @@ cisco_gather_facts:
             ],
             "name": "RED"
           }
+        },
+        "index": {
+          "rd": {
+            "65010:100": "RED",
+            "65010:101": "BLUE",
+            "65010:102": "GREEN",
+            "65010:103": "YELLOW"
+          },
+          "vrf": {
+            "RED": "65010:100",
+            "BLUE": "65010:101",
+            "GREEN": "65010:102",
+            "YELLOW": "65010:103"
+          },
+          "ip": {
+            "10.0.0.1": ["Loopback0", "Loopback100", "Loopback101", "Loopback102", "Loopback103"],
+            "172.16.16.183": ["GigabitEthernet0/0"],
+            "172.16.1.100": ["GigabitEthernet0/0.100"],
+            "172.16.1.101": ["GigabitEthernet0/0.101"],
+            "172.16.1.102": ["GigabitEthernet0/0.102"],
+            "172.16.1.103": ["GigabitEthernet0/0.103"]
+          }
         }
       }
+cisco_hosts:
+    description: Dictionary of facts of every router, keyed by hostname
+    returned: when hostnames is used
+    type: dictionary
+cisco_delta:
+    description:
+      - Differences with the facts of the previous run, for the interfaces,
+        VRFs, BGP neighbors and RDs gathered. Everything is added on the first run.
+    returned: when snapshot_dir is used
+    type: dictionary
+    sample:
+      "cisco_delta": {
+        "changed": true,
+        "interfaces": {
+          "added": ["Loopback103", "GigabitEthernet0/0.103"],
+          "removed": [],
+          "changed": {
+            "GigabitEthernet0/1": {
+              "status": {"before": "down/down", "after": "up/up"}
+            }
+          }
+        },
+        "vrf": {
+          "added": ["YELLOW"],
+          "removed": [],
+          "changed": {}
+        },
+        "neighbor": {
+          "added": [],
+          "removed": [],
+          "changed": {}
+        },
+        "rd": {
+          "added": ["65010:103"],
+          "removed": []
+        }
+      }
+cisco_hosts_delta:
+    description: cisco_delta of every router, keyed by hostname
+    returned: when hostnames and snapshot_dir are used
+    type: dictionary
+cache:
+    description: Number of routers whose facts were taken from the cache (hits) or gathered (misses)
+    returned: when cache_dir is used
+    type: dictionary
+    sample:
+      "cache": {
+        "hits": 1,
+        "misses": 0
+      }
+export_run:
+    description: Run number of the rows appended to export_db
+    returned: when export_db is used
+    type: int
+    sample: 12
+errors:
+    description: Error message of every router that could not be gathered, keyed by hostname
+    returned: when hostnames is used
+    type: dictionary
+    sample:
+      "errors": {
+        "10.1.1.7": "Authentication failed."
+      }
+timings:
+    description:
+      - Seconds spent in every phase, waiting for every show command and in
+        every parser, with the bytes received for every show command. Keyed
+        by hostname when hostnames is used.
+    returned: when timings is used
+    type: dictionary
+    sample:
+      "timings": {
+        "phases": {"connect": 0.81, "enable": 1.02, "total": 6.4},
+        "commands": {
+          "interfaces": {"seconds": 2.31, "bytes": 1894211},
+          "vrf": {"seconds": 1.01, "bytes": 3120}
+        },
+        "parsers": {"interfaces": 0.42, "vrf": 0.0011}
+      }
 '''
 
+import os
+import re
 import sys
+import json
+import time
+import socket
 import string
+import sqlite3
+import threading
 
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 from netlib.conn_type import SSH
 from netaddr import *
 from ansible.module_utils.basic import *
 
 
+class brokerError(Exception):
+  pass
+
+
+class brokerChannel(object):
+  """Paramiko channel look-alike that reads and writes the broker session"""
+  def __init__(self, session):
+    self.session = session
+    self.pending = ''
+
+  def sendall(self, data):
+    self.session.request(op='send', data=data)
+
+  def recv_ready(self):
+    if not self.pending:
+      self.pending = self.session.request(op='recv', timeout=0.05)['output']
+    return len(self.pending) > 0
+
+  def recv(self, size):
+    self.recv_ready()
+    data = self.pending[:size]
+    self.pending = self.pending[size:]
+    return data
+
+
+class brokerSSH(object):
+  """Session borrowed from cisco_broker, used like a netlib SSH object"""
+  def __init__(self, socketPath, hostname, username, password, enable):
+    self.socketPath = socketPath
+    self.hostname = hostname
+    self.username = username
+    self.password = password
+    self.enable = enable
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self.socketPath)
+    self.stream = self.sock.makefile('rw')
+    self.client_conn = brokerChannel(self)
+    self.request(op='open', hostname=self.hostname, username=self.username,
+                 password=self.password, enable=self.enable)
+
+  def request(self, **request):
+    self.stream.write(json.dumps(request) + '\n')
+    self.stream.flush()
+    reply = json.loads(self.stream.readline())
+    if 'error' in reply:
+      raise brokerError(reply['error'])
+    return reply
+
+  def set_enable(self, enable):
+    # Broker sessions are already enabled
+    pass
+
+  def command(self, command):
+    return self.request(op='command', command=command)['output']
+
+  def close(self):
+    self.stream.close()
+    self.sock.close()
+
+
+def openSession(hostname, username, password, enable, broker=None, timings=None):
+  start = time.time()
+  if broker and os.path.exists(broker):
+    session = brokerSSH(broker, hostname, username, password, enable)
+    try:
+      session.connect()
+      if timings is not None:
+        timings.phase('connect', time.time() - start)
+      return session
+    except (socket.error, ValueError):
+      # Stale socket or broker not answering, connect directly
+      pass
+
+  ssh = SSH(hostname, username, password)
+  ssh.connect()
+  connected = time.time()
+  ssh.set_enable(enable)
+  if timings is not None:
+    timings.phase('connect', connected - start)
+    timings.phase('enable', time.time() - connected)
+  return ssh
+
+
+MARKER = "!cisco_gather_facts"
+
+SHOW_COMMANDS = [
+  ('bgp', "show ip bgp summary"),
+  ('rd', "show ip bgp vpnv4 all | inc Route Distinguisher"),
+  ('version', "show version"),
+  ('interfaces', "show interfaces"),
+  ('brief', "show ip interface brief"),
+  ('description', "show interfaces description"),
+  ('vrf', "show ip vrf"),
+  ('hostname', "show run | inc hostname"),
+]
+
+# Show commands, by key in SHOW_COMMANDS, needed by every subset of facts
+FACT_SUBSETS = {
+  'bgp': ['bgp', 'rd'],
+  'version': ['version'],
+  'interfaces': ['interfaces'],
+  'vrf': ['vrf'],
+  'hostname': ['hostname'],
+}
+
+# Subsets read from the running-config, the others change without a
+# configuration change (BGP sessions, interface status, uptime)
+CONFIG_SUBSETS = set(['vrf', 'hostname'])
+
+
+def parseSubset(gatherSubset):
+  include = set()
+  exclude = set()
+  minimal = False
+  for subset in gatherSubset:
+    subset = subset.strip()
+    excluded = subset.startswith('!')
+    name = subset.lstrip('!')
+    if name == 'all':
+      # !all only drops the default, explicit subsets are still gathered
+      if excluded:
+        minimal = True
+      else:
+        include.update(FACT_SUBSETS)
+    elif name not in FACT_SUBSETS:
+      raise ValueError("Unknown gather_subset: " + subset)
+    elif excluded:
+      exclude.add(name)
+    else:
+      include.add(name)
+
+  if not include and not minimal:
+    include = set(FACT_SUBSETS)
+  return include - exclude
+
+
+def interfaceSuffix(name):
+  # "GigabitEthernet0/0.100" and "Gi0/0.100" both end with "0/0.100"
+  for position, character in enumerate(name):
+    if character.isdigit():
+      return name[position:]
+  return name
+
+
+class factCache(object):
+  """Facts of every router in a JSON file of the cache directory"""
+  def __init__(self, directory, ttl=3600, probe=True):
+    self.directory = directory
+    self.ttl = ttl
+    self.probe = probe
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def path(self, hostname):
+    return os.path.join(self.directory, hostname.replace(os.sep, '_') + '.json')
+
+  def load(self, hostname, subset, variant):
+    try:
+      with open(self.path(hostname)) as f:
+        entry = json.load(f)
+    except (IOError, ValueError):
+      return None
+    # Only usable when every requested subset was gathered
+    if not subset.issubset(entry['subset']):
+      return None
+    # Interfaces gathered in another mode are not the ones requested
+    if 'interfaces' in subset and entry.get('variant') != variant:
+      return None
+    return entry
+
+  def select(self, entry, subset):
+    return dict((key, value) for key, value in entry['facts'].items() if key in subset)
+
+  def fresh(self, entry):
+    return time.time() - entry['timestamp'] < self.ttl
+
+  def store(self, hostname, subset, variant, facts, lastChange):
+    entry = dict(timestamp=time.time(), lastChange=lastChange,
+                 subset=sorted(subset), variant=variant, facts=facts)
+    path = self.path(hostname)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(entry, f)
+    os.rename(path + '.tmp', path)
+
+  def count(self, hit):
+    with self.lock:
+      if hit:
+        self.hits += 1
+      else:
+        self.misses += 1
+
+  def stats(self):
+    return dict(hits=self.hits, misses=self.misses)
+
+
+def indexFacts(facts):
+  index = dict(rd={}, vrf={}, ip={})
+  for rd in facts.get('bgp', {}).get('rd', []):
+    index['rd'][rd] = None
+  for name, vrf in facts.get('vrf', {}).items():
+    # A VRF without RD shows "<not set>", every such VRF would share it
+    rd = vrf['rd'] if ':' in vrf['rd'] else None
+    if rd is not None:
+      index['rd'][rd] = name
+    index['vrf'][name] = rd
+  for name, interface in facts.get('interfaces', {}).items():
+    if 'IP' in interface:
+      index['ip'].setdefault(interface['IP'], []).append(name)
+  for names in index['ip'].values():
+    names.sort()
+  return index
+
+
+def diffFacts(before, after):
+  delta = dict(added=sorted(set(after) - set(before)),
+               removed=sorted(set(before) - set(after)),
+               changed={})
+  for key in set(before) & set(after):
+    if before[key] == after[key]:
+      continue
+    if isinstance(before[key], dict) and isinstance(after[key], dict):
+      changes = {}
+      for attribute in set(before[key]) | set(after[key]):
+        if before[key].get(attribute) != after[key].get(attribute):
+          changes[attribute] = dict(before=before[key].get(attribute),
+                                    after=after[key].get(attribute))
+      delta['changed'][key] = changes
+    else:
+      delta['changed'][key] = dict(before=before[key], after=after[key])
+  return delta
+
+
+class factSnapshots(object):
+  """Last facts of every router in a JSON file of the snapshot directory"""
+  def __init__(self, directory):
+    self.directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def path(self, hostname):
+    return os.path.join(self.directory, hostname.replace(os.sep, '_') + '.json')
+
+  def update(self, hostname, facts):
+    try:
+      with open(self.path(hostname)) as f:
+        previous = json.load(f)
+    except (IOError, ValueError):
+      previous = {}
+
+    # Only the sections gathered in this run are compared
+    delta = {}
+    if 'interfaces' in facts:
+      delta['interfaces'] = diffFacts(previous.get('interfaces', {}), facts['interfaces'])
+    if 'vrf' in facts:
+      delta['vrf'] = diffFacts(previous.get('vrf', {}), facts['vrf'])
+    if 'bgp' in facts:
+      previousBgp = previous.get('bgp', {})
+      delta['neighbor'] = diffFacts(previousBgp.get('neighbor', {}), facts['bgp']['neighbor'])
+      rd = diffFacts(dict.fromkeys(previousBgp.get('rd', [])), dict.fromkeys(facts['bgp']['rd']))
+      del rd['changed']
+      delta['rd'] = rd
+    delta['changed'] = any(section['added'] or section['removed'] or section.get('changed')
+                           for section in delta.values())
+
+    # Sections not gathered this time are kept from the previous snapshot
+    previous.update(facts)
+    path = self.path(hostname)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(previous, f)
+    os.rename(path + '.tmp', path)
+    return delta
+
+
+EXPORT_TABLES = [
+  ('interfaces', ['name', 'status', 'IP', 'mask', 'vlanid', 'mtu', 'mac', 'hardware',
+                  'encapsulation', 'description'], ['name', 'IP']),
+  ('vrfs', ['name', 'rd'], ['name', 'rd']),
+  ('vrf_interfaces', ['vrf', 'interface'], ['vrf']),
+  ('neighbors', ['neighbor', 'AS', 'version'], ['neighbor']),
+  ('rds', ['rd', 'vrf'], ['rd']),
+]
+
+class factExport(object):
+  """Facts of every run appended to SQLite tables.
+
+  Every table has run and hostname columns, and a current_<table> view with
+  the rows of the last run that gathered that table for every router."""
+  def __init__(self, path, timeout=60):
+    self.path = path
+    self.connection = sqlite3.connect(path, timeout=timeout)
+    with self.connection:
+      self.connection.execute("CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, time REAL)")
+      self.connection.execute("CREATE TABLE IF NOT EXISTS gathered (run INTEGER, hostname TEXT, "
+                              "section TEXT)")
+      self.connection.execute("CREATE INDEX IF NOT EXISTS gathered_hostname ON gathered "
+                              "(section, hostname, run)")
+      for table, columns, indexes in EXPORT_TABLES:
+        self.connection.execute("CREATE TABLE IF NOT EXISTS %s (run INTEGER, hostname TEXT, %s)"
+                                % (table, ", ".join('"%s" TEXT' % column for column in columns)))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS %s_hostname ON %s (hostname, run)"
+                                % (table, table))
+        for column in indexes:
+          self.connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s ("%s")'
+                                  % (table, column, table, column))
+        self.connection.execute(
+          "CREATE VIEW IF NOT EXISTS current_%s AS SELECT t.* FROM %s t JOIN "
+          "(SELECT hostname, MAX(run) AS run FROM gathered WHERE section = '%s' GROUP BY hostname) l "
+          "ON t.hostname = l.hostname AND t.run = l.run" % (table, table, table))
+
+  def rows(self, facts):
+    # Rows of every table for the facts of one router
+    rows = dict((table, []) for table, columns, indexes in EXPORT_TABLES)
+    if 'interfaces' in facts:
+      for name, interface in facts['interfaces'].items():
+        rows['interfaces'].append([interface.get(column) for column in EXPORT_TABLES[0][1]])
+    if 'vrf' in facts:
+      for name, vrf in facts['vrf'].items():
+        rows['vrfs'].append([name, vrf['rd']])
+        for interface in vrf['interfaces']:
+          rows['vrf_interfaces'].append([name, interface])
+    if 'bgp' in facts:
+      for neighbor in facts['bgp']['neighbor'].values():
+        rows['neighbors'].append([neighbor['neighbor'], neighbor['AS'], neighbor['version']])
+      vrfs = dict((vrf['rd'], name) for name, vrf in facts.get('vrf', {}).items())
+      for rd in facts['bgp']['rd']:
+        rows['rds'].append([rd, vrfs.get(rd)])
+    sections = dict(interfaces='interfaces', vrfs='vrf', vrf_interfaces='vrf',
+                    neighbors='bgp', rds='bgp')
+    return dict((table, tableRows) for table, tableRows in rows.items()
+                if sections[table] in facts)
+
+  def store(self, hosts):
+    # One transaction for the facts of all the routers of the run
+    with self.connection:
+      run = self.connection.execute("INSERT INTO runs (time) VALUES (?)", (time.time(),)).lastrowid
+      for hostname, facts in hosts.items():
+        for table, tableRows in self.rows(facts).items():
+          self.connection.execute("INSERT INTO gathered VALUES (?, ?, ?)", (run, hostname, table))
+          columns = [columns for name, columns, indexes in EXPORT_TABLES if name == table][0]
+          self.connection.executemany(
+            "INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * (len(columns) + 2))),
+            [[run, hostname] + row for row in tableRows])
+    return run
+
+  def close(self):
+    self.connection.close()
+
+
+RD_INDEX_SCHEMA = [
+  "CREATE TABLE IF NOT EXISTS rds (rd TEXT, hostname TEXT, vrf TEXT, allocated INTEGER, "
+  "time REAL, PRIMARY KEY (rd, hostname))",
+  "CREATE TABLE IF NOT EXISTS vrfs (name TEXT, hostname TEXT, rd TEXT, allocated INTEGER, "
+  "time REAL, PRIMARY KEY (name, hostname))",
+  "CREATE INDEX IF NOT EXISTS vrfs_rd ON vrfs (rd)",
+  "CREATE TABLE IF NOT EXISTS next_rd (asn TEXT PRIMARY KEY, number INTEGER)",
+]
+
+class rdIndex(object):
+  """RDs and VRF names of every router, shared with cisco_rd_index.
+
+  Gathered rows of a router are replaced by the ones of its last run, RDs
+  allocated by cisco_rd_index stay until a run gathers them."""
+  def __init__(self, path, timeout=60):
+    self.connection = sqlite3.connect(path, timeout=timeout)
+    with self.connection:
+      for statement in RD_INDEX_SCHEMA:
+        self.connection.execute(statement)
+
+  def update(self, hosts):
+    now = time.time()
+    with self.connection:
+      for hostname, facts in hosts.items():
+        if 'vrf' in facts:
+          self.connection.execute("DELETE FROM vrfs WHERE hostname = ? AND allocated = 0", (hostname,))
+          self.connection.executemany(
+            "INSERT OR REPLACE INTO vrfs VALUES (?, ?, ?, 0, ?)",
+            [(name, hostname, vrf['rd'], now) for name, vrf in facts['vrf'].items()])
+        if 'bgp' in facts:
+          # Without the vrf subset, the VRF of an RD is the one it was allocated for
+          vrfs = dict((vrf['rd'], name) for name, vrf in facts.get('vrf', {}).items())
+          self.connection.execute("DELETE FROM rds WHERE hostname = ? AND allocated = 0", (hostname,))
+          self.connection.executemany(
+            "INSERT OR REPLACE INTO rds VALUES (?, ?, COALESCE(?, "
+            "(SELECT vrf FROM rds WHERE rd = ? AND hostname = ?)), 0, ?)",
+            [(rd, hostname, vrfs.get(rd), rd, hostname, now) for rd in facts['bgp']['rd']])
+
+  def close(self):
+    self.connection.close()
+
+
+class factTimings(object):
+  """Where the time of one router goes: phases, show commands and parsers"""
+  def __init__(self, hostname):
+    self.hostname = hostname
+    self.phases = {}
+    self.commands = {}
+    self.parsers = {}
+    self.reading = 0.0
+
+  def phase(self, name, seconds):
+    self.phases[name] = self.phases.get(name, 0) + seconds
+
+  def command(self, key, seconds, size):
+    entry = self.commands.setdefault(key, dict(seconds=0, bytes=0))
+    entry['seconds'] += seconds
+    entry['bytes'] += size
+    self.reading += seconds
+
+  def lines(self, key, lines):
+    # Only the time spent waiting for every line is counted, not the
+    # time of the consumer between two lines
+    while True:
+      start = time.time()
+      try:
+        line = next(lines)
+      except StopIteration:
+        self.command(key, time.time() - start, 0)
+        return
+      self.command(key, time.time() - start, len(line) + 1)
+      yield line
+
+  def sections(self, sections):
+    # Waiting for the echo of a burst command is part of its time
+    while True:
+      start = time.time()
+      try:
+        key, lines = next(sections)
+      except StopIteration:
+        return
+      self.command(key, time.time() - start, 0)
+      yield key, self.lines(key, lines)
+
+  def parse(self, name, parser, *args):
+    # Streamed parsers also wait for the router, that time is not parsing
+    reading = self.reading
+    start = time.time()
+    result = parser(*args)
+    seconds = time.time() - start - (self.reading - reading)
+    self.parsers[name] = self.parsers.get(name, 0) + seconds
+    return result
+
+  def report(self):
+    commands = dict((key, dict(seconds=round(entry['seconds'], 4), bytes=entry['bytes']))
+                    for key, entry in self.commands.items())
+    return dict(phases=dict((name, round(seconds, 4)) for name, seconds in self.phases.items()),
+                commands=commands,
+                parsers=dict((name, round(seconds, 4)) for name, seconds in self.parsers.items()))
+
+
+TRACE_LOCK = threading.Lock()
+
+def writeTrace(path, record):
+  # One JSON object per line, routers gathered at once append in turn
+  with TRACE_LOCK:
+    with open(path, 'a') as f:
+      f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def toText(data):
+  if isinstance(data, bytes) and not isinstance(data, str):
+    return data.decode('utf-8', 'ignore')
+  return data
+
+
+def iterChannelLines(channel, timeout):
+  # Lines keep their '\r', only the line being received is held in memory.
+  # Bytes are decoded a line at a time, never in the middle of a character.
+  pending = bytearray()
+  deadline = time.time() + timeout
+  while True:
+    if channel.recv_ready():
+      data = channel.recv(65535)
+      if not isinstance(data, (bytes, bytearray)):
+        data = data.encode('utf-8')
+      end = data.rfind(b'\n')
+      if end < 0:
+        pending.extend(data)
+      else:
+        pending.extend(data[:end])
+        for line in toText(bytes(pending)).split('\n'):
+          yield line
+        pending = bytearray(data[end + 1:])
+      deadline = time.time() + timeout
+    elif time.time() > deadline:
+      raise IOError("Timeout waiting for router output")
+    else:
+      time.sleep(0.01)
+
+
+MARKER_LINE = re.compile(re.escape(MARKER) + r" (\d+)\r?$")
+
+def iterSection(lines, state):
+  # Lines up to the next comment echo, ending with the prompt in front of it
+  for line in lines:
+    match = MARKER_LINE.search(line)
+    if match:
+      state['next'] = int(match.group(1))
+      yield line[:match.start()]
+      return
+    yield line
+  state['next'] = None
+
+
+def iterBurst(channel, commands, timeout):
+  # All commands are sent at once, each preceded by a numbered comment.
+  # The lines between two comment echoes are the output of one command,
+  # starting with its echo and ending with the prompt like ssh.command().
+  payload = "terminal length 0\n"
+  for number, (key, command) in enumerate(commands):
+    payload += "%s %d\n%s\n" % (MARKER, number, command)
+  payload += "%s %d\n" % (MARKER, len(commands))
+
+  while channel.recv_ready():
+    channel.recv(65535)
+  channel.sendall(payload)
+
+  lines = iterChannelLines(channel, timeout)
+  state = {}
+  for line in iterSection(lines, state):
+    pass
+  while state['next'] is not None and state['next'] < len(commands):
+    section = iterSection(lines, state)
+    yield commands[state['next']][0], section
+    for line in section:
+      pass
+
+
+PROMPT_LINE = re.compile(r"^([\w.\-/]+)[>#]\s*(.*?)\s*$")
+
+def captureName(command):
+  # "show ip bgp summary" is saved as show_ip_bgp_summary or show_ip_bgp_summary.txt
+  return re.sub(r"\W+", "_", command).strip("_")
+
+
+class captureSource(object):
+  """Saved show outputs of a router, read instead of an SSH session.
+
+  The outputs are either one file per command in capture_dir/<hostname>/, or
+  a session log capture_dir/<hostname>.log where every command follows the
+  prompt. Sections are returned like ssh.command(): starting with the echo
+  of the command, ending with the prompt and with '\\r' line endings."""
+  def __init__(self, directory, hostname):
+    self.directory = directory
+    self.hostname = hostname
+    self.log = None
+
+  @staticmethod
+  def hostnames(directory):
+    hostnames = []
+    for entry in sorted(os.listdir(directory)):
+      if os.path.isdir(os.path.join(directory, entry)):
+        hostnames.append(entry)
+      elif entry.endswith(".log"):
+        hostnames.append(entry[:-4])
+    return hostnames
+
+  def commandPath(self, command):
+    for name in (captureName(command), captureName(command) + ".txt"):
+      path = os.path.join(self.directory, self.hostname, name)
+      if os.path.isfile(path):
+        return path
+    return None
+
+  def logSections(self):
+    # Every command of the session log, the prompt line of the next command
+    # closes the section like the prompt closes the output of ssh.command()
+    sections = {}
+    prompt = None
+    section = None
+    with open(os.path.join(self.directory, self.hostname + ".log")) as f:
+      for line in f:
+        line = line.rstrip("\r\n") + "\r"
+        match = PROMPT_LINE.match(line)
+        if match and (prompt is None or match.group(1) == prompt):
+          prompt = match.group(1)
+          if section is not None:
+            section.append(line)
+          section = [line]
+          if match.group(2):
+            sections[" ".join(match.group(2).split())] = section
+        elif section is not None:
+          section.append(line)
+    if section is not None:
+      section.append(prompt + "#")
+    return sections
+
+  def lines(self, command):
+    path = self.commandPath(command)
+    if path is None:
+      if self.log is None:
+        if not os.path.isfile(os.path.join(self.directory, self.hostname + ".log")):
+          raise IOError("No capture of '%s' for %s" % (command, self.hostname))
+        self.log = self.logSections()
+      if command not in self.log:
+        raise IOError("No capture of '%s' for %s" % (command, self.hostname))
+      return iter(self.log[command])
+    return self.fileLines(path, command)
+
+  def fileLines(self, path, command):
+    # Echo and prompt are added when the collector did not save them
+    last = None
+    with open(path) as f:
+      for line in f:
+        line = line.rstrip("\r\n") + "\r"
+        if last is None:
+          match = PROMPT_LINE.match(line)
+          if not match or " ".join(match.group(2).split()) != command:
+            yield "%s#%s\r" % (self.hostname, command)
+        last = line
+        yield line
+    if last is None or not PROMPT_LINE.match(last) or PROMPT_LINE.match(last).group(2):
+      yield self.hostname + "#"
+
+  def sections(self, commands):
+    for key, command in commands:
+      yield key, self.lines(command)
+
+  def close(self):
+    pass
+
+
+class showTemplate(object):
+  """Regex table of a show command, compiled into a single pattern so every
+  line is matched once. Rules are (name, regex), the named groups of the
+  regex are the fields of the rule."""
+  def __init__(self, rules):
+    self.fields = {}
+    alternatives = []
+    position = 0
+    for name, regex in rules:
+      compiled = re.compile(regex)
+      if compiled.groups != len(compiled.groupindex):
+        raise ValueError("Only named groups are allowed in rule " + name)
+      groups = compiled.groupindex
+      # The fields of a rule follow its own group in match.groups()
+      self.fields[name] = (tuple(sorted(groups, key=groups.get)),
+                           position + 1, position + 1 + compiled.groups)
+      position += 1 + compiled.groups
+      # Field names are prefixed with the rule, rules may share them
+      regex = re.sub(r"\(\?P<(\w+)>", r"(?P<%s_\1>" % name, regex)
+      alternatives.append("(?P<%s>%s)" % (name, regex))
+    self.pattern = re.compile("|".join(alternatives))
+
+  def match(self, line):
+    # (rule, fields) of the first rule matching the beginning of line
+    match = self.pattern.match(line)
+    if match is None:
+      return None, None
+    rule = match.lastgroup
+    fields, first, last = self.fields[rule]
+    return rule, dict(zip(fields, match.groups()[first:last]))
+
+
 class ciscoRouter(object):
+  parser = 'legacy'
+
   def __init__(self,
                username='admin',
                password='123',
                enable='123',
-               hostname='192.168.0.1'):
+               hostname='192.168.0.1',
+               broker=None,
+               burst=False,
+               timeout=120,
+               subset=None,
+               cache=None,
+               interfacesMode='full',
+               interfacesDetail=None,
+               timings=False,
+               traceFile=None,
+               capture=None,
+               parsePool=None):
 
     self.username = username
     self.password = password
     self.enable = enable
     self.hostname = hostname
+    self.broker = broker
+    self.burst = burst
+    self.timeout = timeout
+    if subset is None:
+      subset = set(FACT_SUBSETS)
+    self.subset = subset
+    self.cache = cache
+    self.interfacesMode = interfacesMode
+    self.interfacesDetail = interfacesDetail
+    self.recordTimings = timings or bool(traceFile)
+    self.traceFile = traceFile
+    self.timings = None
+    self.capture = capture
+    self.parsePool = parsePool
 
-  def interfaceBlockManipulate(self, interfaceBlock):
-    interface = {}
-    for line in interfaceBlock:
-      if "line protocol is" in line:
-        interface['name'] = line[:line.find(" ")]
-        firstStatus = len(interface['name'])+4
-        comma = line.find(",")
-        interface['status'] = string.strip(line[firstStatus:comma] + "/" + line[comma+19:-1])
-      if "Hardware is " in line:
-        interface['hardware'] = line[14:line.find(" ",14)]
-      if "Internet address is" in line:
-        ip = IPNetwork(line[22:-1])
-        interface['IP'] = str(ip.ip)
-        interface['mask'] = str(ip.netmask)
-      if "MTU" in line:
-        interface['mtu'] = line[6:line.find(" ",6)]
+  # Detail lines of show interfaces are dispatched on the word after the indent
+  INTERFACE_LINES = {
+    'Hard': 'interfaceHardwareLine',
+    'Inte': 'interfaceAddressLine',
+    'MTU ': 'interfaceMtuLine',
+    'Enca': 'interfaceEncapsulationLine',
+  }
+
+  def interfaceHeaderLine(self, interface, line):
+    interface['name'] = line[:line.find(" ")]
+    firstStatus = len(interface['name'])+4
+    comma = line.find(",")
+    interface['status'] = string.strip(line[firstStatus:comma] + "/" + line[comma+19:-1])
+
+  def interfaceHardwareLine(self, interface, line):
+    if line.startswith("  Hardware is "):
+      interface['hardware'] = line[14:line.find(" ",14)]
       if "Internal MAC" in line:
         macBegin = line.find("address is")+11
         interface['mac'] = line[macBegin:macBegin+14]
-      if "Encapsulation" in line:
-        interface['encapsulation'] = line[16:line.find(",")]
-      if "Vlan ID " in line:
-        vlanBegin = line.find("Vlan ID")+9
-        interface['vlanid'] = line[vlanBegin:line.find(".",vlanBegin)]
 
+  def interfaceAddressLine(self, interface, line):
+    if line.startswith("  Internet address is"):
+      ip = IPNetwork(line[22:-1])
+      interface['IP'] = str(ip.ip)
+      interface['mask'] = str(ip.netmask)
+
+  def interfaceMtuLine(self, interface, line):
+    interface['mtu'] = line[6:line.find(" ",6)]
 
-    return interface
+  def interfaceEncapsulationLine(self, interface, line):
+    interface['encapsulation'] = line[16:line.find(",")]
+    if "Vlan ID " in line:
+      vlanBegin = line.find("Vlan ID")+9
+      interface['vlanid'] = line[vlanBegin:line.find(".",vlanBegin)]
+
+  def iterInterfaces(self, lines):
+    # Single pass over show interfaces, one interface is built at a time.
+    # Echo, prompt and blank lines are skipped.
+    interface = None
+    for line in lines:
+      if line[:1] == " ":
+        if interface is not None:
+          handler = self.INTERFACE_LINES.get(line[2:6])
+          if handler is not None:
+            getattr(self, handler)(interface, line)
+      elif "line protocol is" in line:
+        if interface is not None:
+          yield interface
+        interface = {}
+        self.interfaceHeaderLine(interface, line)
+    if interface is not None:
+      yield interface
+
+  def interfaceBlockManipulate(self, interfaceBlock):
+    for interface in self.iterInterfaces(interfaceBlock):
+      return interface
+    return {}
 
 
   def vrfBlockManipulate(self, vrfBlock):
@@ -329,17 +1353,203 @@ class ciscoRouter(object):
     return vrf
 
 
+  def variant(self):
+    return dict(interfaces_mode=self.interfacesMode,
+                interfaces_detail=self.interfacesDetail,
+                parser=self.parser)
+
+
   def facts(self):
+    if not self.recordTimings:
+      return self.cachedFacts()
+
+    self.timings = factTimings(self.hostname)
+    start = time.time()
+    error = None
+    try:
+      return self.cachedFacts()
+    except Exception as e:
+      error = str(e)
+      raise
+    finally:
+      self.timings.phase('total', time.time() - start)
+      if self.traceFile:
+        record = dict(time=round(start, 3), hostname=self.hostname,
+                      timings=self.timings.report())
+        if error is not None:
+          record['error'] = error
+        writeTrace(self.traceFile, record)
+
+
+  def cachedFacts(self):
+
+    if self.capture is not None:
+      # Offline, the same parsers on the saved outputs
+      return self.gather(captureSource(self.capture, self.hostname))
+
+    cached = None
+    if self.cache is not None:
+      cached = self.cache.load(self.hostname, self.subset, self.variant())
+      if cached is not None and self.cache.fresh(cached):
+        self.cache.count(True)
+        return self.cache.select(cached, self.subset)
+
+    ssh = openSession(self.hostname, self.username, self.password,
+                      self.enable, self.broker, self.timings)
+    try:
+      if self.cache is None:
+        return self.gather(ssh)
+
+      lastChange = self.lastChange(ssh)
+      if (cached is not None and self.cache.probe and lastChange
+          and lastChange == cached['lastChange']):
+        # Only the subsets read from the configuration are still valid, the
+        # others are kept for the next run only when gathered again now
+        subset = (set(cached['subset']) & CONFIG_SUBSETS) | self.subset
+        facts = dict((key, value) for key, value in cached['facts'].items() if key in subset)
+        live = self.subset - CONFIG_SUBSETS
+        if live:
+          facts.update(self.gather(ssh, live))
+        self.cache.count(True)
+        self.cache.store(self.hostname, subset, self.variant() if 'interfaces' in live
+                         else cached.get('variant'), facts, lastChange)
+        return self.cache.select(dict(cached, facts=facts), self.subset)
+
+      facts = self.gather(ssh)
+      self.cache.count(False)
+      self.cache.store(self.hostname, self.subset, self.variant(), facts, lastChange)
+      return facts
+    finally:
+      ssh.close()
+
+
+  def stream(self, ssh, commands):
+    # (key, lines) of every command, lines are read as they are consumed
+    if self.capture is not None:
+      for section in self.timedSections(ssh.sections(commands)):
+        yield section
+      return
+
+    if self.burst:
+      for section in self.timedSections(iterBurst(ssh.client_conn, commands, self.timeout)):
+        yield section
+      return
 
-    ssh = SSH(self.hostname, self.username, self.password)
-    ssh.connect()
-    ssh.set_enable(self.enable)
     ssh.command("terminal length 0")
+    for key, command in commands:
+      if key == 'interfaces':
+        # Streamed from the channel instead of held as a whole
+        for section in self.timedSections(iterBurst(ssh.client_conn, [(key, command)], self.timeout)):
+          yield section
+      else:
+        start = time.time()
+        output = ssh.command(command)
+        if self.timings is not None:
+          self.timings.command(key, time.time() - start, len(output))
+        yield key, iter(string.split(output, '\n'))
+    ssh.command("end")
+
+
+  def timedSections(self, sections):
+    if self.timings is None:
+      return sections
+    return self.timings.sections(sections)
+
+
+  def parse(self, name, parser, *args):
+    if self.timings is None:
+      return parser(*args)
+    return self.timings.parse(name, parser, *args)
+
+
+  def collect(self, ssh, commands):
+    reports = {}
+    for key, lines in self.stream(ssh, commands):
+      reports[key] = '\n'.join(lines)
+    return reports
+
+
+  def lastChange(self, ssh):
+    # "! Last configuration change at ..." or "! No configuration change since last restart"
+    report = self.collect(ssh, [('lastChange', "show run | inc configuration change")])
+    for line in string.split(report['lastChange'], '\n'):
+      if line.startswith("! "):
+        return line.strip()
+    return None
+
+
+  def gather(self, ssh, subset=None):
+
+    if subset is None:
+      subset = self.subset
+    keys = set()
+    for name in subset:
+      keys.update(FACT_SUBSETS[name])
+    if 'interfaces' in keys and self.interfacesMode == 'brief':
+      keys.remove('interfaces')
+      keys.update(['brief', 'description'])
+    commands = [(key, command) for key, command in SHOW_COMMANDS if key in keys]
+
+    facts = {}
+    reports = {}
+    for key, lines in self.stream(ssh, commands):
+      if key == 'interfaces' and self.parsePool is None:
+        facts['interfaces'] = self.parse('interfaces', self.interfacesLinesManipulate, lines)
+      else:
+        reports[key] = '\n'.join(lines)
 
+    if 'brief' in reports:
+      interfaces = self.parse('brief', self.briefReportManipulate,
+                              reports['brief'], reports['description'])
+      if self.interfacesDetail:
+        pattern = re.compile('(?:%s)$' % self.interfacesDetail)
+        detailCommands = [(name, "show interfaces " + name)
+                          for name in sorted(interfaces) if pattern.match(name)]
+        for name, lines in self.stream(ssh, detailCommands):
+          detail = self.parse('interfaces', self.interfacesLinesManipulate, lines)
+          interfaces[name].update(detail.get(name, {}))
+      facts['interfaces'] = interfaces
 
-    # GET BGP Data
+    tasks = self.parseTasks(reports, subset)
+    if self.parsePool is None:
+      results = [self.parse(name, getattr(self, method), *args) for name, method, args in tasks]
+    else:
+      # Collection is over, the reports are parsed by the process pool
+      results = []
+      for (name, method, args), (result, seconds) in zip(tasks, self.parsePool.map(
+          parseTask, [(self.parser, method, args) for name, method, args in tasks])):
+        if self.timings is not None:
+          self.timings.parsers[name] = self.timings.parsers.get(name, 0) + seconds
+        results.append(result)
+
+    for (name, method, args), result in zip(tasks, results):
+      if name == 'interfaces':
+        facts.setdefault('interfaces', {}).update(result)
+      else:
+        facts[name] = result
+    return facts
+
+
+  def parseTasks(self, reports, subset):
+    # (fact, parser, arguments) of every report still to be parsed
+    tasks = []
+    if 'interfaces' in reports:
+      for chunk in interfaceChunks(reports['interfaces'], INTERFACE_CHUNK):
+        tasks.append(('interfaces', 'interfacesReportManipulate', (chunk,)))
+    if 'version' in subset:
+      tasks.append(('version', 'versionReportManipulate', (reports['version'],)))
+    if 'hostname' in subset:
+      tasks.append(('hostname', 'hostnameReportManipulate', (reports['hostname'],)))
+    if 'bgp' in subset:
+      tasks.append(('bgp', 'bgpReportManipulate', (reports['bgp'], reports['rd'])))
+    if 'vrf' in subset:
+      tasks.append(('vrf', 'vrfReportManipulate', (reports['vrf'],)))
+    return tasks
+
+
+  def bgpReportManipulate(self, summaryReport, rdReport):
     bgp = {}
-    bgpReport = string.split(ssh.command("show ip bgp summary"),'\n')
+    bgpReport = string.split(summaryReport,'\n')
     bgpReport.pop()
 
     comma = bgpReport[1].find(",")
@@ -365,7 +1575,7 @@ class ciscoRouter(object):
       bgp['neighbor'][neighbor['neighbor']] = neighbor
       counter += 1
 
-    bgpReport = string.split(ssh.command("show ip bgp vpnv4 all | inc Route Distinguisher"),'\n')
+    bgpReport = string.split(rdReport,'\n')
     counter = 1
     numLines = len(bgpReport)
 
@@ -376,54 +1586,79 @@ class ciscoRouter(object):
       if counter > numLines -2:
         break
 
-    bgpReport = []
-
+    return bgp
 
 
-    # GET VERSION
+  def versionReportManipulate(self, report):
     version = {}
-    versionReport = string.split(ssh.command("show version"),'\n')
+    versionReport = string.split(report,'\n')
 
     for line in versionReport:
       if 'System image' in line:
         version['image']=line[28:-2]
 
-    versionReport = []
+    return version
+
+
+  def interfacesReportManipulate(self, report):
+    return self.interfacesLinesManipulate(iter(string.split(report,'\n')))
 
 
-    # GET INTERFACES
+  def interfacesLinesManipulate(self, lines):
     interfaces = {}
-    interfacesReport = string.split(ssh.command("show interfaces"),'\n')
-    interfacesReport.pop()
+    for interface in self.iterInterfaces(lines):
+      interfaces[interface['name']] = interface
+    return interfaces
 
-    counter = 1
-    numLines = len(interfacesReport)
 
-    while True:
-      line = interfacesReport[counter]
-      if line[0] != " ":
-        interfaceBlock = []
-        interfaceBlock.append(line)
-        counter += 1
-        while True:
-          line = interfacesReport[counter]
-          if line[0] == " ":
-            interfaceBlock.append(line)
-            counter += 1
-          else:
-            break
-          if counter > numLines - 1:
-            break
-      interface = self.interfaceBlockManipulate(interfaceBlock)
+  def briefReportManipulate(self, briefReport, descriptionReport):
+    interfaces = {}
+    order = []
+    briefReport = string.split(briefReport,'\n')
+    briefReport.pop()
+
+    for line in briefReport[2:]:
+      # Interface IP-Address OK? Method Status Protocol, status may be two words
+      fields = line.split()
+      if len(fields) < 6:
+        continue
+      interface = {}
+      interface['name'] = fields[0]
+      interface['status'] = " ".join(fields[4:-1]) + "/" + fields[-1]
+      if fields[1] != "unassigned":
+        interface['IP'] = fields[1]
       interfaces[interface['name']] = interface
-      if counter > numLines - 1:
-        break
+      order.append(interface['name'])
+
+    descriptionReport = string.split(descriptionReport,'\n')
+    descriptionReport.pop()
+    if len(descriptionReport) < 2:
+      return interfaces
+
+    header = descriptionReport[1]
+    statusColumn = header.find("Status")
+    descriptionColumn = header.find("Description")
+    rows = []
+    for line in descriptionReport[2:]:
+      if line.strip():
+        rows.append((line[:statusColumn].strip(), line[descriptionColumn:].strip()))
+
+    # Both commands list the interfaces in the same order, only the names
+    # of show interfaces description are abbreviated
+    pairs = list(zip(order, rows))
+    if len(rows) != len(order) or [1 for name, (shortName, description) in pairs
+                                   if interfaceSuffix(name) != interfaceSuffix(shortName)]:
+      return interfaces
+    for name, (shortName, description) in pairs:
+      if description:
+        interfaces[name]['description'] = description
+
+    return interfaces
 
-    interfacesReport = []
 
-    # GET VRF
+  def vrfReportManipulate(self, report):
     vrf = {}
-    vrfReport = string.split(ssh.command("show ip vrf"),'\n')
+    vrfReport = string.split(report,'\n')
     vrfReport.pop()
 
     counter = 2
@@ -448,23 +1683,200 @@ class ciscoRouter(object):
       singleVrf = self.vrfBlockManipulate(vrfBlock)
       vrf[singleVrf['name']] = singleVrf
 
-    vrfReport = []
+    return vrf
 
 
-    # GET HOSTNAME
-    hostname = string.split(ssh.command("show run | inc hostname"),'\n')[1][9:-1]
+  def hostnameReportManipulate(self, report):
+    return string.split(report,'\n')[1][9:-1]
 
 
-    ssh.command("end")
-    ssh.close()
+class regexRouter(ciscoRouter):
+  """ciscoRouter whose parsers match the lines against showTemplate tables
+  instead of slicing them at fixed columns"""
+  parser = 'regex'
 
-    facts = {}
-    facts['version'] = version
-    facts['hostname'] = hostname
-    facts['interfaces'] = interfaces
-    facts['bgp'] = bgp
-    facts['vrf'] = vrf
-    return facts
+  INTERFACES = showTemplate([
+    ('header', r"(?P<name>\S+) is (?P<status>.*?), line protocol is (?P<protocol>.*?)\s*$"),
+    ('hardware', r"  Hardware is (?P<hardware>[^\s,]+)(?:.*?Internal MAC, address is (?P<mac>[0-9a-f.]{14}))?"),
+    ('address', r"  Internet address is (?P<address>[\d./]+)"),
+    ('mtu', r"  MTU (?P<mtu>\d+) "),
+    ('encapsulation', r"  Encapsulation (?P<encapsulation>[^,\r]*)(?:.*?Vlan ID\s+(?P<vlanid>\d+))?"),
+  ])
+
+  VRF = showTemplate([
+    ('header', r"\s+Name\s+Default RD"),
+    ('vrf', r"  (?P<name>\S+)\s+(?P<rd><not set>|\S+)(?:\s+(?P<interface>\S+))?"),
+    ('interface', r"\s{3,}(?P<interface>\S+)"),
+  ])
+
+  BGP = showTemplate([
+    ('identifier', r"BGP router identifier (?P<identifier>[^,]+), local AS number (?P<AS>[\d.]+)"),
+    ('neighbor', r"(?P<neighbor>\d+\.\d+\.\d+\.\d+)\s+(?P<version>\d)\s+(?P<AS>[\d.]+)\s"),
+  ])
+
+  RD = showTemplate([
+    ('rd', r"Route Distinguisher: (?P<rd>\S+)"),
+  ])
+
+  VERSION = showTemplate([
+    ('image', r'System image file is "(?:[\w\-]+:)?(?P<image>[^"]*)"'),
+  ])
+
+  HOSTNAME = showTemplate([
+    ('hostname', r"hostname (?P<hostname>\S+)"),
+  ])
+
+  def iterInterfaces(self, lines):
+    interface = None
+    for line in lines:
+      rule, fields = self.INTERFACES.match(line)
+      if rule is None:
+        continue
+      if rule == 'header':
+        if interface is not None:
+          yield interface
+        interface = dict(name=fields['name'],
+                         status="%s/%s" % (fields['status'].strip(), fields['protocol']))
+      elif interface is None:
+        continue
+      elif rule == 'address':
+        ip = IPNetwork(fields['address'])
+        interface['IP'] = str(ip.ip)
+        interface['mask'] = str(ip.netmask)
+      else:
+        for field, value in fields.items():
+          if value is not None:
+            interface[field] = value
+    if interface is not None:
+      yield interface
+
+
+  def vrfReportManipulate(self, report):
+    vrf = {}
+    singleVrf = None
+    for line in string.split(report,'\n'):
+      rule, fields = self.VRF.match(line)
+      if rule == 'vrf':
+        singleVrf = dict(name=fields['name'], rd=fields['rd'], interfaces=[])
+        vrf[singleVrf['name']] = singleVrf
+      if rule in ('vrf', 'interface') and singleVrf is not None and fields['interface']:
+        singleVrf['interfaces'].append(fields['interface'])
+    return vrf
+
+
+  def bgpReportManipulate(self, summaryReport, rdReport):
+    bgp = dict(neighbor={}, rd=[])
+    for line in string.split(summaryReport,'\n'):
+      rule, fields = self.BGP.match(line)
+      if rule == 'identifier':
+        bgp['identifier'] = fields['identifier']
+        bgp['AS'] = fields['AS']
+      elif rule == 'neighbor':
+        bgp['neighbor'][fields['neighbor']] = fields
+
+    for line in string.split(rdReport,'\n'):
+      rule, fields = self.RD.match(line)
+      if rule == 'rd':
+        bgp['rd'].append(fields['rd'])
+    return bgp
+
+
+  def versionReportManipulate(self, report):
+    version = {}
+    for line in string.split(report,'\n'):
+      rule, fields = self.VERSION.match(line)
+      if rule == 'image':
+        version['image'] = fields['image']
+    return version
+
+
+  def hostnameReportManipulate(self, report):
+    for line in string.split(report,'\n'):
+      rule, fields = self.HOSTNAME.match(line)
+      if rule == 'hostname':
+        return fields['hostname']
+    return None
+
+
+PARSERS = {
+  'legacy': ciscoRouter,
+  'regex': regexRouter,
+}
+
+
+# Interfaces parsed by a single task of the parse pool
+INTERFACE_CHUNK = 250
+
+def interfaceChunks(report, size):
+  # show interfaces cut before the header of every size-th interface
+  chunks = []
+  chunk = []
+  count = 0
+  for line in string.split(report, '\n'):
+    if line[:1] != " " and "line protocol is" in line:
+      if count == size:
+        chunks.append('\n'.join(chunk))
+        chunk = []
+        count = 0
+      count += 1
+    chunk.append(line)
+  chunks.append('\n'.join(chunk))
+  return chunks
+
+
+def parseTask(task):
+  # Runs in the parse pool, the parsers only need a bare ciscoRouter
+  parser, method, args = task
+  start = time.time()
+  result = getattr(PARSERS[parser](), method)(*args)
+  return result, time.time() - start
+
+
+def gatherDevice(device, snapshots=None, index=True):
+  timings = None
+  try:
+    facts = device.facts()
+    if device.timings is not None:
+      timings = device.timings.report()
+    delta = None
+    if snapshots is not None:
+      delta = snapshots.update(device.hostname, facts)
+    if index:
+      facts['index'] = indexFacts(facts)
+    return device.hostname, facts, delta, None, timings
+  except Exception as e:
+    if device.timings is not None:
+      timings = device.timings.report()
+    return device.hostname, None, None, str(e), timings
+
+
+def gatherFacts(devices, workers=20, snapshots=None, index=True, processes=False):
+  # Threads wait for routers, processes share the parsing of saved outputs
+  # between CPUs. Results come back from processes, not the devices.
+  if processes:
+    pool = Pool(max(1, min(workers, cpu_count(), len(devices))))
+  else:
+    pool = ThreadPool(max(1, min(workers, len(devices))))
+  try:
+    results = pool.map(partial(gatherDevice, snapshots=snapshots, index=index), devices)
+  finally:
+    pool.close()
+    pool.join()
+
+  facts = {}
+  deltas = {}
+  errors = {}
+  timings = {}
+  for hostname, hostFacts, delta, error, hostTimings in results:
+    if error is None:
+      facts[hostname] = hostFacts
+      if delta is not None:
+        deltas[hostname] = delta
+    else:
+      errors[hostname] = error
+    if hostTimings is not None:
+      timings[hostname] = hostTimings
+  return facts, deltas, errors, timings
 
 
 
@@ -472,35 +1884,161 @@ def main():
 
   module = AnsibleModule(
     argument_spec=dict(
-      hostname=dict(required=True),
-      username=dict(required=True),
-      password=dict(required=True),
-      enable=dict(required=True),
-      )
+      hostname=dict(required=False),
+      hostnames=dict(required=False, type='list'),
+      workers=dict(required=False, type='int', default=20),
+      gather_subset=dict(required=False, type='list', default=['all']),
+      interfaces_mode=dict(required=False, default='full', choices=['full', 'brief']),
+      interfaces_detail=dict(required=False),
+      cache_dir=dict(required=False),
+      cache_ttl=dict(required=False, type='int', default=3600),
+      cache_probe=dict(required=False, type='bool', default=True),
+      snapshot_dir=dict(required=False),
+      index=dict(required=False, type='bool', default=True),
+      burst=dict(required=False, type='bool', default=False),
+      timeout=dict(required=False, type='int', default=120),
+      username=dict(required=False),
+      password=dict(required=False),
+      enable=dict(required=False),
+      broker=dict(required=False, default='/tmp/cisco_broker.sock'),
+      timings=dict(required=False, type='bool', default=False),
+      trace_file=dict(required=False),
+      capture_dir=dict(required=False),
+      parse_workers=dict(required=False, type='int', default=0),
+      parser=dict(required=False, default='legacy', choices=list(PARSERS)),
+      export_db=dict(required=False),
+      rd_index=dict(required=False),
+      ),
+    required_one_of=[['hostname', 'hostnames', 'capture_dir']],
+    mutually_exclusive=[['hostname', 'hostnames']]
   )
 
 
   hostname = module.params['hostname']
+  hostnames = module.params['hostnames']
+  workers = module.params['workers']
+  index = module.params['index']
   username = module.params['username']
   password = module.params['password']
   enable = module.params['enable']
+  capture = module.params['capture_dir']
   changed = False
   commandResult = False
   msg = ""
 
+  if capture is None and None in (username, password, enable):
+    module.fail_json(msg="username, password and enable are required unless capture_dir is used")
+  if capture is not None and not os.path.isdir(capture):
+    module.fail_json(msg="capture_dir is not a directory: " + capture)
+  if capture is not None and not hostname and not hostnames:
+    # Every router saved in capture_dir
+    hostnames = captureSource.hostnames(capture)
+
+  try:
+    subset = parseSubset(module.params['gather_subset'])
+  except ValueError as e:
+    module.fail_json(msg=str(e))
+
+  if module.params['interfaces_detail']:
+    try:
+      re.compile(module.params['interfaces_detail'])
+    except re.error as e:
+      module.fail_json(msg="Invalid interfaces_detail: " + str(e))
+
+  cache = None
+  if module.params['cache_dir'] and capture is None:
+    cache = factCache(module.params['cache_dir'],
+                      ttl=module.params['cache_ttl'],
+                      probe=module.params['cache_probe'])
+
+  snapshots = None
+  if module.params['snapshot_dir']:
+    snapshots = factSnapshots(module.params['snapshot_dir'])
+
+  export = None
+  if module.params['export_db']:
+    try:
+      export = factExport(module.params['export_db'])
+    except sqlite3.Error as e:
+      module.fail_json(msg="Cannot open export_db: " + str(e))
+
+  rdDatabase = None
+  if module.params['rd_index']:
+    try:
+      rdDatabase = rdIndex(module.params['rd_index'])
+    except sqlite3.Error as e:
+      module.fail_json(msg="Cannot open rd_index: " + str(e))
+
+  parsePool = None
+  if module.params['parse_workers'] > 0 and capture is None:
+    # Started before the gathering threads, forking them would be unsafe
+    parsePool = Pool(module.params['parse_workers'])
+
+  options = dict(username=username,
+                 password=password,
+                 enable=enable,
+                 broker=module.params['broker'],
+                 burst=module.params['burst'],
+                 timeout=module.params['timeout'],
+                 subset=subset,
+                 cache=cache,
+                 interfacesMode=module.params['interfaces_mode'],
+                 interfacesDetail=module.params['interfaces_detail'],
+                 timings=module.params['timings'],
+                 traceFile=module.params['trace_file'],
+                 capture=capture,
+                 parsePool=parsePool)
+  routerClass = PARSERS[module.params['parser']]
+  result = {}
+
+  if hostnames is not None and hostname is None:
+    devices = [routerClass(hostname=host, **options) for host in hostnames]
+    facts, deltas, errors, timings = gatherFacts(devices, workers, snapshots, index,
+                                                 processes=capture is not None)
+    if parsePool is not None:
+      parsePool.close()
+    ansibleFacts = dict(cisco_hosts=facts)
+    if snapshots is not None:
+      ansibleFacts['cisco_hosts_delta'] = deltas
+    if cache is not None:
+      result['cache'] = cache.stats()
+    if module.params['timings']:
+      result['timings'] = timings
+    if export is not None:
+      result['export_run'] = export.store(facts)
+      export.close()
+    if rdDatabase is not None:
+      rdDatabase.update(facts)
+      rdDatabase.close()
+    module.exit_json(ansible_facts=ansibleFacts, errors=errors, **result)
 
-  device = ciscoRouter(hostname=hostname,
-                       username=username,
-                       password=password,
-                       enable=enable)
+  device = routerClass(hostname=hostname, **options)
 
   facts = device.facts()
+  if parsePool is not None:
+    parsePool.close()
+  ansibleFacts = dict(cisco=facts)
+  if snapshots is not None:
+    ansibleFacts['cisco_delta'] = snapshots.update(hostname, facts)
+  if index:
+    facts['index'] = indexFacts(facts)
+  if cache is not None:
+    result['cache'] = cache.stats()
+  if module.params['timings']:
+    result['timings'] = device.timings.report()
+  if export is not None:
+    result['export_run'] = export.store({hostname: facts})
+    export.close()
+  if rdDatabase is not None:
+    rdDatabase.update({hostname: facts})
+    rdDatabase.close()
 
 #############################################
 # Dump
 #############################################
 #  print json.dumps(facts, indent=2)
 
-  module.exit_json(ansible_facts=dict(cisco=facts))
+  module.exit_json(ansible_facts=ansibleFacts, **result)
 
-main()
+if __name__ == '__main__':
+  main()
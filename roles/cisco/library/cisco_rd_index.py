@@ -0,0 +1,285 @@
+#! /usr/bin/python
+
+# Copyright 2016 Antonio Arriaga Diaz <antonio.arriaga.diaz@gmail.com >
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+DOCUMENTATION = '''
+---
+module: cisco_rd_index
+short_description: Check and allocate RDs in the fleet RD index
+description:
+    - Answer whether an RD and a VRF name are free in the whole fleet, or
+      allocate the next free RD, from the index kept by cisco_gather_facts
+      with rd_index. No router is contacted.
+    - An RD is free when no router has it, or when the routers that have it
+      use it for the same VRF. An RD only known by BGP (a reflector) belongs
+      to an unknown VRF and is never free.
+    - Allocated RDs are kept in the index until a cisco_gather_facts run
+      finds them in the router, or until they are released.
+    - Without rd, the next RD is searched from the one after the last RD
+      allocated that way, wrapping around to first, so released RDs are
+      used again.
+author: Antonio Arriaga Diaz
+version_added: 1.0
+options:
+  index:
+    description:
+      - SQLite file of the index, the rd_index of cisco_gather_facts.
+    required: true
+  action:
+    description:
+      - check reports whether rd and vrf are free. allocate reserves rd, or
+        the next free RD of AS when rd is not given, for vrf on hostname and
+        fails when it is not free. release removes the allocations of
+        hostname (of rd only when given) not yet found in the router.
+    required: false
+    default: check
+    choices: ["check", "allocate", "release"]
+  rd:
+    description:
+      - RD as AS:number.
+    required: false
+  AS:
+    description:
+      - AS of the RD to allocate when rd is not given.
+    required: false
+  vrf:
+    description:
+      - Name of the VRF the RD is for. Required to allocate.
+    required: false
+  hostname:
+    description:
+      - Router the RD is allocated for. Required to allocate and release.
+    required: false
+  first:
+    description:
+      - Lowest number of the RDs allocated when rd is not given.
+    required: false
+    default: 100
+  last:
+    description:
+      - Highest number of the RDs allocated when rd is not given.
+    required: false
+    default: 65535
+'''
+
+EXAMPLES = '''
+# Abort before touching any router
+- local_action: cisco_rd_index index=/var/lib/cisco/rd.db action=allocate rd=65010:103 vrf=YELLOW hostname={{ inventory_hostname }}
+
+# A new RD for a new VRF
+- local_action: cisco_rd_index index=/var/lib/cisco/rd.db action=allocate AS=65010 vrf=PURPLE hostname={{ inventory_hostname }}
+  register: allocation
+- debug: msg="PURPLE gets {{ allocation.rd }}"
+
+- local_action: cisco_rd_index index=/var/lib/cisco/rd.db rd=65010:103 vrf=YELLOW
+  register: lookup
+- fail: msg="RD 65010:103 is used by {{ lookup.owners }}"
+  when: not lookup.free
+'''
+
+RETURN = '''
+rd:
+    description: RD checked or allocated
+    returned: always, except release without rd
+    type: string
+    sample: "65010:104"
+free:
+    description: The RD is free for vrf
+    returned: check and allocate
+    type: bool
+vrf_free:
+    description: The VRF name is not used with another RD
+    returned: check and allocate, when vrf is given
+    type: bool
+owners:
+    description: Routers that have, or have been allocated, the RD, with its VRF
+    returned: check and allocate
+    type: list
+    sample: [{"hostname": "bras1", "vrf": "YELLOW", "allocated": false}]
+released:
+    description: Number of allocations released
+    returned: release
+    type: int
+'''
+
+import time
+import sqlite3
+from ansible.module_utils.basic import *
+
+
+RD_INDEX_SCHEMA = [
+  "CREATE TABLE IF NOT EXISTS rds (rd TEXT, hostname TEXT, vrf TEXT, allocated INTEGER, "
+  "time REAL, PRIMARY KEY (rd, hostname))",
+  "CREATE TABLE IF NOT EXISTS vrfs (name TEXT, hostname TEXT, rd TEXT, allocated INTEGER, "
+  "time REAL, PRIMARY KEY (name, hostname))",
+  "CREATE INDEX IF NOT EXISTS vrfs_rd ON vrfs (rd)",
+  "CREATE TABLE IF NOT EXISTS next_rd (asn TEXT PRIMARY KEY, number INTEGER)",
+]
+
+
+class rdIndex(object):
+  """RDs and VRF names of every router, filled by cisco_gather_facts"""
+  def __init__(self, path, timeout=60):
+    self.connection = sqlite3.connect(path, timeout=timeout)
+    # Allocations read and write in one transaction, concurrent plays wait
+    self.connection.isolation_level = None
+    for statement in RD_INDEX_SCHEMA:
+      self.connection.execute(statement)
+
+  def owners(self, rd):
+    rows = self.connection.execute("SELECT hostname, vrf, allocated FROM rds WHERE rd = ?", (rd,))
+    owners = [dict(hostname=hostname, vrf=vrf, allocated=bool(allocated))
+              for hostname, vrf, allocated in rows]
+    # Routers that have a VRF with that RD without BGP facts in the index
+    known = set(owner['hostname'] for owner in owners)
+    for name, hostname, allocated in self.connection.execute(
+        "SELECT name, hostname, allocated FROM vrfs WHERE rd = ?", (rd,)):
+      if hostname not in known:
+        owners.append(dict(hostname=hostname, vrf=name, allocated=bool(allocated)))
+    return sorted(owners, key=lambda owner: owner['hostname'])
+
+  def rdFree(self, rd, vrf):
+    # Routers that only know the RD by BGP do not tell its VRF
+    owners = self.owners(rd)
+    vrfs = set(owner['vrf'] for owner in owners if owner['vrf'] is not None)
+    return not owners or vrfs == set([vrf])
+
+  def vrfFree(self, vrf, rd):
+    return all(used == rd for (used,) in self.connection.execute(
+      "SELECT DISTINCT rd FROM vrfs WHERE name = ?", (vrf,)))
+
+  def nextFree(self, AS, vrf, first, last):
+    # From the one after the last automatic allocation, wrapping around to
+    # first so released numbers are found again
+    row = self.connection.execute("SELECT number FROM next_rd WHERE asn = ?", (AS,)).fetchone()
+    start = row[0] if row and first <= row[0] <= last else first
+    for number in list(range(start, last + 1)) + list(range(first, start)):
+      rd = "%s:%d" % (AS, number)
+      if not self.owners(rd) and self.vrfFree(vrf, rd):
+        return rd
+    return None
+
+  def allocate(self, rd, vrf, hostname, automatic=False):
+    now = time.time()
+    self.connection.execute("INSERT OR IGNORE INTO rds VALUES (?, ?, ?, 1, ?)",
+                            (rd, hostname, vrf, now))
+    self.connection.execute("INSERT OR IGNORE INTO vrfs VALUES (?, ?, ?, 1, ?)",
+                            (vrf, hostname, rd, now))
+    # An explicit RD says nothing about the numbers after it
+    if automatic:
+      AS, number = rd.split(':', 1)
+      self.connection.execute("INSERT OR REPLACE INTO next_rd VALUES (?, ?)",
+                              (AS, int(number) + 1))
+
+  def release(self, hostname, rd=None):
+    released = 0
+    for table in ('rds', 'vrfs'):
+      query = "DELETE FROM %s WHERE hostname = ? AND allocated = 1" % table
+      arguments = (hostname,)
+      if rd is not None:
+        query += " AND rd = ?"
+        arguments += (rd,)
+      count = self.connection.execute(query, arguments).rowcount
+      if table == 'rds':
+        released = count
+    return released
+
+  def close(self):
+    self.connection.close()
+
+
+def main():
+
+  module = AnsibleModule(
+    argument_spec=dict(
+      index=dict(required=True),
+      action=dict(required=False, default='check', choices=['check', 'allocate', 'release']),
+      rd=dict(required=False),
+      AS=dict(required=False),
+      vrf=dict(required=False),
+      hostname=dict(required=False),
+      first=dict(required=False, type='int', default=100),
+      last=dict(required=False, type='int', default=65535),
+      ),
+    supports_check_mode=True
+  )
+
+  action = module.params['action']
+  rd = module.params['rd']
+  AS = module.params['AS']
+  vrf = module.params['vrf']
+  hostname = module.params['hostname']
+
+  if rd is not None and ':' not in rd:
+    module.fail_json(msg="rd has to be AS:number: " + rd)
+  if action == 'check' and rd is None and vrf is None:
+    module.fail_json(msg="check needs rd or vrf")
+  if action == 'allocate' and (vrf is None or hostname is None or (rd is None and AS is None)):
+    module.fail_json(msg="allocate needs vrf, hostname and rd or AS")
+  if action == 'release' and hostname is None:
+    module.fail_json(msg="release needs hostname")
+
+  try:
+    index = rdIndex(module.params['index'])
+  except sqlite3.Error as e:
+    module.fail_json(msg="Cannot open index: " + str(e))
+
+  result = {}
+  try:
+    index.connection.execute("BEGIN IMMEDIATE")
+    try:
+      if action == 'release':
+        if rd is not None:
+          result['rd'] = rd
+        if not module.check_mode:
+          result['released'] = index.release(hostname, rd)
+        result['changed'] = result.get('released', 0) > 0
+      else:
+        if rd is None and vrf is not None:
+          # A VRF keeps the RD it already has
+          known = index.connection.execute("SELECT rd FROM vrfs WHERE name = ?", (vrf,)).fetchone()
+          rd = known[0] if known else None
+        automatic = rd is None
+        if rd is None and action == 'allocate':
+          rd = index.nextFree(AS, vrf, module.params['first'], module.params['last'])
+          if rd is None:
+            module.fail_json(msg="No free RD between %s:%d and %s:%d"
+                             % (AS, module.params['first'], AS, module.params['last']))
+        result['rd'] = rd
+        result['owners'] = index.owners(rd) if rd is not None else []
+        result['free'] = rd is None or index.rdFree(rd, vrf)
+        if vrf is not None:
+          result['vrf_free'] = rd is None or index.vrfFree(vrf, rd)
+        result['changed'] = False
+        if action == 'allocate':
+          if not result['free'] or not result['vrf_free']:
+            module.fail_json(msg="RD %s or VRF %s already used" % (rd, vrf), **result)
+          if not any(owner['hostname'] == hostname for owner in result['owners']):
+            if not module.check_mode:
+              index.allocate(rd, vrf, hostname, automatic)
+            result['changed'] = True
+      index.connection.execute("COMMIT")
+    except:
+      index.connection.execute("ROLLBACK")
+      raise
+  except sqlite3.Error as e:
+    module.fail_json(msg="Index error: " + str(e))
+  finally:
+    index.close()
+
+  module.exit_json(**result)
+
+if __name__ == '__main__':
+  main()
@@ -22,6 +22,8 @@ short_description: Execute all lines from a file in a Cisco IOS router via seria
 description:
     - Execute all lines from a file in a Cisco IOS router via serial console.
     - If a line execution return an error, the module will fail.
+    - With ports, several consoles are provisioned at the same time and the
+      result of every console is returned in ports.
 author: Antonio Arriaga Diaz
 version_added: 1.0
 options:
@@ -58,47 +60,445 @@ options:
     default: 8
   timeout:
     description:
-      - Console timeout
+      - Seconds to wait for the prompt after every command
     required: false
     default: 8
   command_file:
     description:
-      - File that contains all Cisco commands
-    required: true
+      - File that contains all Cisco commands. Required unless ports is used.
+    required: false
+  mode:
+    description:
+      - line sends a line and waits for its prompt before the next one. bulk
+        streams the command file in chunks and looks for "% Invalid",
+        "% Incomplete" and "% Ambiguous" in the whole output afterwards,
+        reporting the line that caused the first error. Every chunk ends
+        with a numbered comment; once its echo is followed by a prompt,
+        the router has read the whole chunk.
+    required: false
+    default: line
+    choices: [ "line", "bulk" ]
+  chunk_size:
+    description:
+      - Maximum bytes written at once in bulk mode. Lines are never split.
+        Without flow control, the echo of a chunk is waited for before the
+        next one is written.
+    required: false
+    default: 128
+  capture_limit:
+    description:
+      - Bytes of console output kept in memory in bulk mode. Past it, the
+        output is moved to a temporary file and only its last 64KB stay in
+        memory for the prompt and echo searches.
+    required: false
+    default: 1048576
+  flow_control:
+    description:
+      - Flow control of the console, it has to match the flowcontrol of line con 0.
+    required: false
+    default: none
+    choices: [ "none", "xonxoff", "rtscts" ]
+  console_speed:
+    description:
+      - Baud rate set with speed under line con 0 before the command file is
+        executed. The port is switched to that rate and the original speed is
+        restored at the end.
+    required: false
+  ports:
+    description:
+      - List of consoles to provision concurrently. Every item has a port and
+        a command_file, and may override baudrate, parity, stopbits and
+        bytesize.
+    required: false
 '''
 
 EXAMPLES = '''
 - cisco_serial: "port="/dev/ttyS1 baudrate=18400 command_file="/path/to/file/commandFile"
+
+# Paste a large configuration at 115200 bauds with software flow control
+- cisco_serial: port=/dev/ttyUSB0 command_file=/path/to/file/commandFile mode=bulk flow_control=xonxoff console_speed=115200
+
+# A whole rack through a USB serial hub
+- cisco_serial:
+    ports:
+      - { port: /dev/ttyUSB0, command_file: /path/to/rack1/router1.cfg }
+      - { port: /dev/ttyUSB1, command_file: /path/to/rack1/router2.cfg }
+      - { port: /dev/ttyUSB2, command_file: /path/to/rack1/switch1.cfg, baudrate: 115200 }
 '''
 
+RETURN = '''
+ports:
+    description: Result of every console, keyed by port
+    returned: when ports is used
+    type: dictionary
+    sample:
+      "ports": {
+        "/dev/ttyUSB0": {
+          "success": true,
+          "failed_line": null,
+          "msg": "",
+          "elapsed": 41.5
+        },
+        "/dev/ttyUSB1": {
+          "success": false,
+          "failed_line": 12,
+          "msg": "ip adress 10.0.0.2 255.255.255.255\\r\\n% Invalid input detected at '^' marker.",
+          "elapsed": 9.2
+        }
+      }
+'''
+
+import re
 import serial
 import time
+import select
+import tempfile
+import threading
+import collections
 from ansible.module_utils.basic import *
 
 
-def read_output (serial_port):
-  output = ""
-  time.sleep(1)
-  bytes_to_read = serial_port.inWaiting()
+# Router>, Router#, Router(config-if)#, or a question waiting for an answer
+PROMPT = re.compile(r"(?:^|[\r\n])[\w.\-/]+(?:\([\w.\-/ ]+\))?[>#] ?$"
+                    r"|\[yes/no\]: ?$|\[confirm\] ?$|[Pp]assword: ?$")
+MORE = "--More--"
+# Comment sent after every chunk in bulk mode, its echo is unique
+MARKER = "!cisco_serial"
+
+
+def to_text (data):
+  if isinstance(data, bytes) and not isinstance(data, str):
+    return data.decode('utf-8', 'ignore')
+  return data
+
+
+class capture_buffer(object):
+  """Console output kept in a preallocated bytearray.
+
+  The buffer doubles up to limit bytes. Past it, all but the last keep bytes
+  are moved to a temporary file, so memory stays bounded whatever the size
+  of the output. Offsets count from the start of the capture."""
+  def __init__(self, size=4096, limit=1048576, keep=65536):
+    self.buffer = bytearray(size)
+    self.used = 0
+    self.spilled = 0
+    self.limit = limit
+    self.keep = keep
+    self.spill = None
+
+  def __len__(self):
+    return self.spilled + self.used
+
+  def write(self, data):
+    if not isinstance(data, (bytes, bytearray)):
+      data = data.encode('utf-8')
+    if self.used + len(data) > self.limit:
+      self.spill_old()
+    needed = self.used + len(data)
+    if needed > len(self.buffer):
+      size = len(self.buffer)
+      while size < needed:
+        size *= 2
+      self.buffer.extend(bytearray(size - len(self.buffer)))
+    self.buffer[self.used:needed] = data
+    self.used = needed
+
+  def spill_old(self):
+    start = self.used - self.keep
+    if start <= 0:
+      return
+    if self.spill is None:
+      self.spill = tempfile.TemporaryFile()
+    view = memoryview(self.buffer)
+    self.spill.write(view[:start])
+    view[:self.keep] = view[start:self.used].tobytes()
+    self.spilled += start
+    self.used = self.keep
+
+  def tail(self, size):
+    # Text of the last size bytes, without copying the rest of the buffer
+    return to_text(memoryview(self.buffer)[max(0, self.used - size):self.used].tobytes())
+
+  def find(self, data, start=0):
+    # Offset of data from offset start, only what is still in memory is searched
+    if not isinstance(data, bytes):
+      data = data.encode('utf-8')
+    position = self.buffer.find(data, max(0, start - self.spilled), self.used)
+    if position < 0:
+      return position
+    return self.spilled + position
+
+  def text(self, start=0):
+    # Text from offset start, only what is still in memory
+    start = max(0, start - self.spilled)
+    return to_text(memoryview(self.buffer)[start:self.used].tobytes())
+
+  def getvalue(self):
+    if self.spill is None:
+      return self.text()
+    self.spill.seek(0)
+    return to_text(self.spill.read() + memoryview(self.buffer)[:self.used].tobytes())
+
+  def lines(self):
+    # Every line of the capture, the spilled ones read back from the file
+    pending = b''
+    if self.spill is not None:
+      self.spill.seek(0)
+      for line in self.spill:
+        if not line.endswith(b'\n'):
+          pending = line
+          break
+        yield to_text(line[:-1])
+    for line in to_text(pending + memoryview(self.buffer)[:self.used].tobytes()).split("\n"):
+      yield line
+
+  def close(self):
+    if self.spill is not None:
+      self.spill.close()
+      self.spill = None
+
+
+def read_output (serial_port, timeout=8, capture=None):
+  # Return as soon as the router shows a prompt, or after timeout seconds.
+  # The output is appended to capture, or returned as text without one.
+  own = capture is None
+  if own:
+    capture = capture_buffer()
+  deadline = time.time() + timeout
+  fd = serial_port.fileno()
+
+  while True:
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      break
+    readable = select.select([fd], [], [], remaining)[0]
+    if not readable:
+      break
+    capture.write(serial_port.read(serial_port.inWaiting() or 1))
+
+    tail = capture.tail(200)
+    if tail.rstrip().endswith(MORE):
+      serial_port.write(" ")
+    elif PROMPT.search(tail):
+      break
+
+  if own:
+    output = capture.getvalue()
+    capture.close()
+    return output
+  return capture
+
 
-  while bytes_to_read > 0:
-    output += serial_port.read(bytes_to_read)
+ERRORS = ("% Invalid", "% Incomplete", "% Ambiguous")
 
-    time.sleep(1)
-    bytes_to_read = serial_port.inWaiting()
 
-  return output
+def read_until_echo (serial_port, command, timeout=8, capture=None):
+  # Read until the echo of command has been followed by a prompt
+  own = capture is None
+  if own:
+    capture = capture_buffer()
+  deadline = time.time() + timeout
+  scanned = len(capture)
+  echo = -1
+  while time.time() < deadline:
+    read_output(serial_port, deadline - time.time(), capture)
+    # Only the new output is searched, the echo may start before it
+    found = capture.find(command, max(0, scanned - len(command)))
+    while found >= 0:
+      echo = found
+      found = capture.find(command, echo + 1)
+    scanned = len(capture)
+    if echo >= 0 and PROMPT.search(capture.text(echo + len(command))[-200:]):
+      break
 
+  if own:
+    output = capture.getvalue()
+    capture.close()
+    return output
+  return capture
 
-def execute_command (serial_port, command):
+
+def find_error (lines, command_list):
+  # Echoes appear in the order the lines were sent, an error belongs to the
+  # last echoed line. Returns the line number and the output around the error.
+  sent = [(number, command.strip()) for number, command in enumerate(command_list)
+          if command.strip()]
+  expected = 0
+  current = None
+  previous = collections.deque(maxlen=2)
+  for raw in lines:
+    line = raw.rstrip()
+    if expected < len(sent) and line.endswith(sent[expected][1][-40:]):
+      current = sent[expected][0]
+      expected += 1
+    elif line.startswith(ERRORS):
+      context = "\n".join(list(previous) + [raw])
+      if current is None:
+        return 0, context
+      return current + 1, context
+    previous.append(raw)
+  return None
+
+
+def execute_bulk (serial_port, command_list, chunk_size=128, paced=True, timeout=8,
+                  capture_limit=1048576):
+  commands = [command.rstrip("\r\n") for command in command_list]
+
+  # Room for the marker that ends every chunk
+  budget = chunk_size - len(MARKER) - 8
+  chunks = []
+  chunk = []
+  size = 0
+  for command in commands:
+    if chunk and size + len(command) + 1 > budget:
+      chunks.append(chunk)
+      chunk = []
+      size = 0
+    chunk.append(command)
+    size += len(command) + 1
+  if chunk:
+    chunks.append(chunk)
+
+  # The output of the whole file, past capture_limit it goes to a temporary file
+  capture = capture_buffer(limit=capture_limit)
+  try:
+    for number, chunk in enumerate(chunks):
+      payload = "".join(command + "\r" for command in chunk)
+      if paced:
+        # Without flow control the router input buffer must not overflow,
+        # the echo of the marker tells the whole chunk has been read. A
+        # line of the file could appear more than once.
+        marker = "%s %d" % (MARKER, number)
+        serial_port.write(payload + marker + "\r")
+        read_until_echo(serial_port, marker + "\r", timeout, capture)
+      else:
+        serial_port.write(payload)
+        if serial_port.inWaiting():
+          capture.write(serial_port.read(serial_port.inWaiting()))
+
+    if not paced:
+      marker = "%s %d" % (MARKER, len(chunks))
+      serial_port.write(marker + "\r")
+      read_until_echo(serial_port, marker + "\r", timeout, capture)
+
+    return find_error(capture.lines(), command_list)
+  finally:
+    capture.close()
+
+
+def change_speed (serial_port, speed, timeout=8):
+  execute_command(serial_port,"configure terminal",timeout)
+  execute_command(serial_port,"line con 0",timeout)
+  serial_port.write("speed %s\r" % speed)
+  serial_port.flush()
+  # The router switches as soon as the line is accepted, what it sends in
+  # the meantime is garbage at either rate
+  time.sleep(0.5)
+  serial_port.baudrate = int(speed)
+  time.sleep(0.1)
+  serial_port.flushInput()
+  execute_command(serial_port,"",timeout)
+  execute_command(serial_port,"end",timeout)
+
+
+def execute_command (serial_port, command, timeout=8):
   return_value = [True,""]
+  command = command.rstrip("\r\n")
+  # A prompt left over from the previous command would end the read before
+  # this one is answered, and its error would be reported for the next line
+  serial_port.flushInput()
+  # A single carriage return, a trailing newline would be a second empty command
   serial_port.write(command + "\r")
-  output = read_output(serial_port)
+  if command.strip():
+    output = read_until_echo(serial_port, command.strip(), timeout)
+  else:
+    output = read_output(serial_port, timeout)
   if "% Invalid" in output:
     return_value = [False,output]
   return return_value
 
 
+SERIAL_SETTINGS = ['port', 'baudrate', 'parity', 'stopbits', 'bytesize', 'xonxoff', 'rtscts']
+
+
+def provision (settings, command_file, timeout, mode="line", chunk_size=128,
+               console_speed=None, capture_limit=1048576):
+  # Execute command_file on one console and report how it went
+  result = dict(success=False, failed_line=None, msg="", elapsed=0)
+  start = time.time()
+
+  try:
+    ser = serial.Serial(timeout=timeout, **settings)
+  except (serial.SerialException, ValueError) as e:
+    result['msg'] = str(e)
+    return result
+
+  try:
+    if not ser.isOpen():
+      result['msg'] = "Serial port cannot be opened"
+      return result
+
+# Single return for initiate the cisco console
+    execute_command(ser,"",timeout)
+# Entering enable mode
+    execute_command(ser,"enable",timeout)
+# Avoid the inconvenient "--More--" of cisco paging
+    execute_command(ser,"terminal length 0",timeout)
+
+    with open(command_file) as f:
+      command_list = f.readlines()
+
+    if console_speed:
+      change_speed(ser, console_speed, timeout)
+
+    try:
+      if mode == "bulk":
+        paced = not (settings.get('xonxoff') or settings.get('rtscts'))
+        error = execute_bulk(ser, command_list, chunk_size, paced, timeout, capture_limit)
+        if error:
+          result['failed_line'], result['msg'] = error
+          return result
+      else:
+        for number, command in enumerate(command_list):
+          output = execute_command(ser,command,timeout)
+          if not output[0]:
+            result['failed_line'] = number + 1
+            result['msg'] = output[1]
+            return result
+    finally:
+      if console_speed:
+        execute_command(ser,"end",timeout)
+        change_speed(ser, settings['baudrate'], timeout)
+
+    execute_command(ser,"exit",timeout)
+    result['success'] = True
+    return result
+  finally:
+    ser.close()
+    result['elapsed'] = round(time.time() - start, 2)
+
+
+def provision_all (ports, settings, timeout, options):
+  results = {}
+
+  def worker (entry):
+    port_settings = dict(settings)
+    for key in SERIAL_SETTINGS:
+      if key in entry:
+        port_settings[key] = entry[key]
+    try:
+      results[entry['port']] = provision(port_settings, entry['command_file'], timeout, **options)
+    except Exception as e:
+      results[entry['port']] = dict(success=False, failed_line=None, msg=str(e), elapsed=0)
+
+  threads = [threading.Thread(target=worker, args=(entry,)) for entry in ports]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
+
 def main():
 
   module = AnsibleModule(
@@ -109,11 +509,20 @@ def main():
      stopbits=dict(required=False),
      bytesize=dict(required=False),
      timeout=dict(required=False),
-     command_file=dict(required=True)
-     )
+     command_file=dict(required=False),
+     mode=dict(required=False, default='line', choices=['line', 'bulk']),
+     chunk_size=dict(required=False, type='int', default=128),
+     capture_limit=dict(required=False, type='int', default=1048576),
+     flow_control=dict(required=False, default='none', choices=['none', 'xonxoff', 'rtscts']),
+     console_speed=dict(required=False, type='int'),
+     ports=dict(required=False, type='list')
+     ),
+   required_one_of=[['command_file', 'ports']],
+   mutually_exclusive=[['command_file', 'ports']]
   )
 
   command_file = module.params['command_file']
+  ports = module.params['ports']
   if module.params['port']:
     port = module.params['port']
   else:
@@ -135,33 +544,33 @@ def main():
   else:
     bytesize = 8
   if module.params['timeout']:
-    timeout = module.params['timeout']
+    timeout = float(module.params['timeout'])
   else:
     timeout = 8
 
-  ser = serial.Serial(port=port, baudrate=baudrate, parity=parity, stopbits=stopbits, bytesize=bytesize, timeout=timeout)
-
-  if not ser.isOpen():
-    module.fail_json(msg="Serial port cannot be opened")
-
-# Single return for initiate the cisco console
-  execute_command(ser,"")
-# Entering enable mode
-  execute_command(ser,"enable")
-# Avoid the inconvenient "--More--" of cisco paging
-  execute_command(ser,"terminal length 0")
-
-  with open(command_file) as f:
-    command_list = f.readlines()
+  settings = dict(port=port, baudrate=baudrate, parity=parity, stopbits=stopbits, bytesize=bytesize,
+                  xonxoff=module.params['flow_control'] == 'xonxoff',
+                  rtscts=module.params['flow_control'] == 'rtscts')
+  options = dict(mode=module.params['mode'],
+                 chunk_size=module.params['chunk_size'],
+                 capture_limit=module.params['capture_limit'],
+                 console_speed=module.params['console_speed'])
 
-  for command in command_list:
-    output = execute_command(ser,command)
-    if not output[0]:
-      module.fail_json(msg=output[1])
+  if ports:
+    for entry in ports:
+      if not isinstance(entry, dict) or 'port' not in entry or 'command_file' not in entry:
+        module.fail_json(msg="Every item of ports needs a port and a command_file")
+    results = provision_all(ports, settings, timeout, options)
+    failed = [port for port in results if not results[port]['success']]
+    if failed:
+      module.fail_json(msg="Provisioning failed on " + ", ".join(sorted(failed)), ports=results)
+    module.exit_json(changed=True, ports=results)
 
-  execute_command(ser,"exit")
+  result = provision(settings, command_file, timeout, **options)
+  if not result['success']:
+    module.fail_json(msg=result['msg'], failed_line=result['failed_line'])
 
-  ser.close()
   module.exit_json(changed=True)
 
-main()
+if __name__ == '__main__':
+  main()